@@ -24,6 +24,17 @@ class AcsBundle(ambry.bundle.Bundle, MakeTablesMixin, MakeSourcesMixin,
         ('LOGRECNO','Logical Record Number',7,'int',5 )
     ]
 
+    # Number of processes the table generators use to parse state files. None parses
+    # them serially.
+    generator_processes = None
+
+    # If True, the table generators save their output for each state as it is finished, in
+    # the build directory, so a failed build resumes from the last finished state.
+    generator_checkpoints = False
+
+    # Number of concurrent downloads when pre-downloading the state files
+    download_processes = 4
+
     def init(self):
         from .util import year_release
 
@@ -43,47 +54,74 @@ class AcsBundle(ambry.bundle.Bundle, MakeTablesMixin, MakeSourcesMixin,
 
 
     @CaptureException
-    def _pre_download(self, gen_cls):
+    def _pre_download(self):
+        """Download all of the state files at once, before they are read. The generators
+        and their pool workers only read the state files from the download cache, so they
+        don't contend for the same files. """
+        from .download import download_all
+        from .generator import ACS09StateFileReader
+
+        downloads = []
+
+        # The state archives hold every sequence, so any sequence gives all of the URLs
+        for spec1, spec2 in ACS09StateFileReader(self).generate_source_specs(1):
+
+            downloads.append(spec1.url)
+
+            # The two specs usually point to different files in the same zip archive, but I'm not sure
+            # that is always true. Duplicate URLs are only downloaded once.
+            downloads.append(spec2.url)
+
+        download_all(downloads, self.library.download_cache, processes=self.download_processes,
+                     log=self.log)
+
+    @CaptureException
+    def ingest(self, sources=None, tables=None, stage=None, force=False, update_tables=True):
         """Override the ingestion process to download all of the input files at once. This resolves
         the contention for the files that would occurr if many generators are trying to download
         the same files all at once. """
-        from ambry_sources import download
 
-        cache = self.library.download_cache
+        self._pre_download()
 
-        source = self.source('b00001') # First; any one will do
+        return super(AcsBundle, self).ingest(sources, tables, stage, force, update_tables)
 
-        g = gen_cls(self, source)
+    @CaptureException
+    def ingest_sequences(self, sequences=None, force=False):
+        """Ingest the sources for all of the tables in each sequence in a single pass over the
+        state files, rather than re-reading the same sequence files once for every table.
+        The ingested source files are used by the build in place of running the
+        TableRowGenerator for each table. """
 
-        downloads = []
+        from .generator import ACS09SequenceRowGenerator
 
-        for spec1, spec2 in g.generate_source_specs():
+        if sequences is None:
+            sequences = self.table_catalog.sequences
 
-            downloads.append( (spec1.url, cache) )
+        self._pre_download()
 
-            # The two specs usually point to different files in the same zip archive, but I'm not sure
-            # that is always true.
-            if spec1.url != spec2.url:
-                downloads.append((spec2.url, cache))
+        for sequence in sequences:
+            self._ingest_sequence(ACS09SequenceRowGenerator(self, sequence), force=force)
 
-        # Multi-processing downloads might improve the speed, although probably not by much.
-        for url, cache in downloads:
-            self.log("Pre-downloading: {}".format(url))
-            download(url, cache)
+    def _ingest_sequence(self, g, force=False):
+        """Write the rows from a sequence generator into the datafiles of the table sources"""
+        from .util import needs_ingest, write_sources
 
-class ACS2009Bundle(AcsBundle):
-    pass
+        sources = {}
+        for table_name in g.slicers.keys():
+            s = self.source(table_name)
+            if needs_ingest(s, force):
+                sources[table_name] = s
 
-class ACS2010Bundle(AcsBundle):
+        if not sources:
+            self.log("Sequence {} already ingested".format(g.sequence))
+            return
 
-    @CaptureException
-    def ingest(self, sources=None, tables=None, stage=None, force=False, update_tables=True):
-        """Override the ingestion process to download all of the input files at once. This resolves
-        the contention for the files that would occurr if many generators are trying to download
-        the same files all at once. """
+        self.log("Ingesting sequence {}: {}".format(g.sequence, ', '.join(sorted(sources.keys()))))
 
-        from.generator import ACS09TableRowGenerator
+        write_sources(self, sources, {k: v.headers for k, v in g.slicers.items()}, g)
 
-        self._pre_download(ACS09TableRowGenerator)
+class ACS2009Bundle(AcsBundle):
+    pass
 
-        return super(ACS2010Bundle, self).ingest(sources, tables, stage, force, update_tables)
+class ACS2010Bundle(AcsBundle):
+    pass
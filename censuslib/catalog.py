@@ -0,0 +1,165 @@
+"""
+A catalog of the tables in a census release, built from the table sequence file.
+
+The catalog is built once for each year and release, and saved in the library download
+cache, so the sequence file doesn't have to be scanned again to find the layout of a table
+or the tables in a sequence.
+
+"""
+
+
+class TableCatalog(object):
+    """The tables of a release, with their sequence layouts and columns"""
+
+    def __init__(self, year, release, tables):
+        """
+        :param tables: An OrderedDict of table id to a dict of name, universe, description,
+            columns and data, as the keyword arguments to MakeTablesMixin.make_table()
+        """
+        from collections import defaultdict
+
+        self.year = int(year)
+        self.release = int(release)
+        self.tables = tables
+
+        self._by_sequence = defaultdict(list)
+
+        for table_id, d in self.tables.items():
+            self._by_sequence[int(d['data']['sequence'])].append(table_id)
+
+    @classmethod
+    def from_rows(cls, rows, year, release, limit=None, log=None):
+        """Build a catalog from the rows of the table sequence file.
+
+        :param rows: An iterable of dicts, for the rows of the table sequence file
+        :param limit: If given, stop at the first new table after this many rows of the release
+        :param log: A function that takes a string, for reporting
+        """
+        from collections import OrderedDict
+
+        tables = OrderedDict()
+        column_names = {}
+
+        year, release = int(year), int(release)
+
+        table_name = None
+        ignore = set()
+        n_other = 0
+        i = 0
+
+        for row in rows:
+
+            if int(row['year']) != year or int(row['release']) != release:
+                n_other += 1
+                continue
+
+            if row['table_id'] in ignore:
+                continue
+
+            if int(row['sequence_number']) > 117:
+                # Not sure where the higher sequence numbers are, but they aren't in this distribution.
+                continue
+
+            i += 1
+
+            table_name = row['table_id']
+
+            if row['start']:
+
+                # Breaking here ensures we've loaded all of the columns for
+                # the previous tables.
+                if limit and i > limit:
+                    break
+
+                if table_name in tables:
+                    ignore.add(table_name)
+                    continue
+
+                tables[table_name] = dict(
+                    name=row['table_id'],
+                    universe=None,
+                    description=row['title'].title(),
+                    columns=[],
+                    data=dict(
+                        sequence=int(row['sequence_number']),
+                        start=int(float(row['start'])),
+                        length=int(row['table_cells']),
+                    )
+                )
+
+                column_names[table_name] = set()
+
+            elif 'Universe' in row['title']:
+                tables[table_name]['universe'] = row['title'].replace('Universe: ', '').strip()
+
+            elif row['is_column'] == 'Y':
+
+                col_name = table_name + "{:03d}".format(int(row['line']))
+
+                if col_name in column_names[table_name]:
+                    raise Exception("Already have {} in {}".format(col_name, table_name))
+
+                column_names[table_name].add(col_name)
+
+                tables[table_name]['columns'].append(dict(
+                    name=col_name,
+                    description=row['title'],
+                    datatype='float',
+                    data=dict(start=row['segment_column']))
+                )
+
+                # Add the margin of error column
+                tables[table_name]['columns'].append(dict(
+                    name=col_name + '_m90',
+                    description="Margin of error for: " + col_name,
+                    datatype='float',
+                    data=dict(start=row['segment_column']))
+                )
+
+        if log and n_other:
+            log("Ignored {} sequence rows for other years and releases".format(n_other))
+
+        return cls(year, release, tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __contains__(self, table_id):
+        return table_id in self.tables
+
+    def table(self, table_id):
+        """Return the dict for a table. Raises KeyError if it isn't in the catalog"""
+        return self.tables[table_id]
+
+    def sequence(self, sequence):
+        """Return the ids of the tables in a sequence, in the order of the sequence file"""
+        return list(self._by_sequence.get(int(sequence), []))
+
+    @property
+    def sequences(self):
+        """The sorted sequence numbers"""
+        return sorted(self._by_sequence.keys())
+
+    def to_data(self):
+        """Return the catalog as data for JSON"""
+        return dict(year=self.year, release=self.release, tables=self.tables)
+
+    @classmethod
+    def from_data(cls, d):
+        return cls(d['year'], d['release'], d['tables'])
+
+    @classmethod
+    def cached(cls, cache, key, year, release, rows_f, log=None):
+        """Load the catalog for a year and release from a cache, or build it from the rows
+        returned by rows_f() and save it.
+
+        :param key: A string that identifies the source of the rows, such as the versioned id
+            of the table sequence partition
+        """
+        from collections import OrderedDict
+        from .util import cached_json, versioned_cache_path
+
+        path = versioned_cache_path('catalog', '{}-{}-{}'.format(key, year, release), '.json')
+
+        return cached_json(cache, path, lambda: cls.from_rows(rows_f(), year, release, log=log),
+                           cls.to_data, cls.from_data, object_pairs_hook=OrderedDict)
@@ -8,25 +8,70 @@ import numpy as np
 from six import string_types
 
 
-def melt(df):
-    """Melt a census dataframe into two value columns, for the estimate and margin"""
+def melt(df, id_cols=9):
+    """Melt a census dataframe into two value columns, for the estimate and margin
+
+    The estimate and margin columns follow the first id_cols columns, alternating in pairs
+    of <col> and <col>_m90, so they are paired by position, and the value arrays are
+    reshaped directly.
+
+    :param df: A census dataframe, with a gvid column
+    :param id_cols: The number of leading columns that aren't estimates or margins
+    :return: A dataframe with value and m90 columns, indexed on gvid and variable
+    """
     import pandas as pd
 
-    # Intial melt
-    melted = pd.melt(df, id_vars=list(df.columns[:9]), value_vars=list(df.columns[9:]))
-    melted = melted[['gvid', 'variable', 'value']]
+    estimate_cols = list(df.columns[id_cols::2])
+    margin_cols = list(df.columns[id_cols+1::2])
+
+    if [c + '_m90' for c in estimate_cols] != margin_cols:
+        raise ValueError("Estimate and margin columns are not in alternating pairs")
+
+    estimates = np.asarray(df.iloc[:, id_cols::2], dtype=float)
+    margins = np.asarray(df.iloc[:, id_cols+1::2], dtype=float)
+
+    n_rows, n_cols = estimates.shape
+
+    # Ordered by variable, then by row, as pd.melt() orders them
+    index = pd.MultiIndex.from_arrays(
+        [np.tile(np.asarray(df['gvid']), n_cols), np.repeat(estimate_cols, n_rows)],
+        names=['gvid', 'variable'])
 
-    # Make two seperate frames for estimates and margins.
-    estimates = melted[~melted.variable.str.contains('_m90')].set_index(['gvid', 'variable'])
-    margins = melted[melted.variable.str.contains('_m90')].copy()
+    return pd.DataFrame({'value': estimates.ravel(order='F'), 'm90': margins.ravel(order='F')},
+                        index=index, columns=['value', 'm90'])
 
-    margins.columns = ['gvid', 'ovariable', 'm90']
-    margins['variable'] = margins.ovariable.str.replace('_m90', '')
+def ratio_margins(rate, n_m90, d, d_m90, subset=True):
+    """Return the 90% margins for ratios of a numerator to a denominator. The arguments are
+    arrays, or anything that broadcasts with them, including a boolean array for subset.
 
-    # Join the estimates to the margins.
-    final = estimates.join(margins.set_index(['gvid', 'variable']).drop('ovariable', 1))
+    From external_documentation.acs_handbook, Appendix A, "Calculating MOEs for Derived
+    Proportions", when the numerator is a subset of the denominator the margin is computed
+    from the difference of the squared terms. Where that is negative, the acs_handbook
+    recommends using the method for "Calculating MOEs for Derived Ratios", where the
+    numerator is not a subset of the denominator. Since our numerator is a subset, the
+    handbook says " use the formula for derived ratios in the next section which will
+    provide a conservative estimate of the MOE." The handbook says this case should be rare,
+    but for this calculation, it happens about 50% of the time.
+
+    :param rate: The ratios
+    :param n_m90: Margins of the numerators
+    :param d: Denominators
+    :param d_m90: Margins of the denominators
+    :param subset: True where the numerator is a subset of the denominator
+    """
+
+    n_sq = np.square(n_m90)
+    d_sq = np.square(rate) * np.square(d_m90)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportion = n_sq - d_sq
+
+        # The ratio formula where the numerator is not a subset, or the proportion
+        # formula would take the root of a negative number
+        use_ratio = np.logical_not(subset) | (proportion < 0)
+
+        return np.sqrt(np.where(use_ratio, n_sq + d_sq, proportion)) / d
 
-    return final
 
 class CensusSeries(AmbrySeries):
 
@@ -70,50 +115,177 @@ class CensusSeries(AmbrySeries):
         return self.m90() / 1.645 * 2.575
 
 
+class ColumnIndex(object):
+    """Positions of the columns of a census dataframe, by name and by column number, the
+    number in the last three digits of an estimate column name. """
+
+    def __init__(self, columns):
+
+        self.columns = columns
+
+        self.positions = {}
+        self.numbers = {}
+        self.margins = {}
+
+        for i, name in enumerate(columns):
+            name = str(name)
+
+            self.positions[name] = i
+
+            if name.endswith('_m90'):
+                continue
+
+            if name[-3:].isdigit():
+                # The first column with a number, as with the old scan of the column names
+                self.numbers.setdefault(int(name[-3:]), name)
+
+        for name in self.positions:
+            if name + '_m90' in self.positions:
+                self.margins[name] = name + '_m90'
+
+    def name(self, c):
+        """Return the name of a column, given its name or number"""
+        if isinstance(c, (int, np.integer)):
+            return self.numbers[int(c)]
+
+        if c not in self.positions:
+            raise KeyError(c)
+
+        return c
+
+    def position(self, c):
+        """Return the position of a column, given its name or number"""
+        return self.positions[self.name(c)]
+
+    def margin(self, c):
+        """Return the name of the margin column for an estimate, or None if there isn't one"""
+        return self.margins.get(self.name(c))
+
+    def range(self, first, last):
+        """Return the names of the estimate columns numbered from first to last, inclusive"""
+        return [self.numbers[i] for i in range(first, last+1)]
+
+
 class CensusDataFrame(AmbryDataFrame):
 
+    @property
+    def column_index(self):
+        """A ColumnIndex for the frame's columns. It is cached on the frame, and rebuilt when
+        the columns change. """
+
+        ci = self.__dict__.get('_column_index')
+
+        if ci is None or ci.columns is not self.columns:
+            ci = ColumnIndex(self.columns)
+            object.__setattr__(self, '_column_index', ci)
+
+        return ci
+
+    @property
+    def column_meta(self):
+        """A dict of column name to the ambry column from the partition's table. It is built
+        once, and shared with the frames that are sliced or copied from this frame. Derived
+        columns aren't in the table, so they aren't in the dict. """
+
+        meta = self.__dict__.get('_column_meta')
+
+        if meta is None:
+            partition = getattr(self, 'partition', None)
+
+            if partition is not None:
+                meta = {c.name: c for c in partition.table.columns}
+            else:
+                meta = {}
 
+            object.__setattr__(self, '_column_meta', meta)
+
+        return meta
 
     def lookup(self, c):
-        from ambry.orm.exc import NotFoundError
-
-        if isinstance(c, string_types):
-            c =  self[c]
-        if isinstance(c, int):
-            suffix = str(c).zfill(3)
-            full_col = [col for col in self.columns if col.endswith(suffix)][0]
-            c = self[full_col]
+
+        if isinstance(c, (string_types, int, np.integer)):
+            c = self[self.column_index.name(c)]
         else:
             pass
 
-        try:
-            c.ambry_column = self.partition.table.column(c.name)
-        except NotFoundError:
-            c.ambry_column = None
+        c.ambry_column = self.column_meta.get(c.name)
 
         return c
 
-    def sum_m(self, *cols):
-        """Sum a set of Dataframe series and return the summed series and margin. The series must have names"""
+    def _column_name(self, c):
+        """Return the name of a column, given its name, its number, or a series of this frame.
+        Only the name of a series is used, so a series from any other frame, or one that was
+        derived from a column, is rejected, rather than having its values silently ignored. """
+        from pandas import Series
+
+        if isinstance(c, Series):
+            if getattr(c, '_dataframe', None) is not self:
+                raise ValueError("Series '{}' is not a column of this dataframe".format(c.name))
+
+            c = c.name
+
+        return self.column_index.name(c)
+
+    def value_arrays(self, cols):
+        """Return two 2-D float arrays, with the estimates and the margins of a list of columns
+        in the columns of the arrays.
+
+        :param cols: A list of column names, column numbers, or series named for columns
+        """
+
+        ci = self.column_index
+
+        names = [self._column_name(c) for c in cols]
+
+        estimates = np.asarray(self.iloc[:, [ci.position(c) for c in names]], dtype=float)
+        margins = np.asarray(self.iloc[:, [ci.position(ci.margin(c)) for c in names]], dtype=float)
+
+        return estimates, margins
+
+    def sum_m_groups(self, groups):
+        """Sum groups of columns, and propagate the error margins. All of the columns of all
+        of the groups are gathered into a single pair of arrays, and each group is reduced from
+        those.
+
+        :param groups: A dict, or a list of pairs, of the name of a result column to the list of
+            columns to sum for it, which can be column names, numbers, or named series
+        :return: A dataframe with columns for each group's sum and its <name>_m90 margin
+        """
+        from collections import OrderedDict
+
+        groups = OrderedDict(groups.items() if isinstance(groups, dict) else groups)
+
+        cols = []
+        group_slices = []
+
+        for name, group_cols in groups.items():
+            group_slices.append(slice(len(cols), len(cols) + len(group_cols)))
+            cols.extend(group_cols)
+
+        estimates, margins = self.value_arrays(cols)
 
         # See the ACS General Handbook, Appendix A, "Calculating MOEs for
         # Derived Proportions". (https://www.census.gov/content/dam/Census/library/publications/2008/acs/ACSGeneralHandbook.pdf)
         # for a guide to these calculations.
+        margins_sq = margins * margins
 
-        # This is for the case when the numerator is a subset of the denominator
+        out = OrderedDict()
 
-        # Convert string column names to columns.
+        for name, sl in zip(groups.keys(), group_slices):
+            out[name] = estimates[:, sl].sum(axis=1)
+            out[name + '_m90'] = np.sqrt(margins_sq[:, sl].sum(axis=1))
 
-        if len(cols) == 1 and isinstance(cols[0], (list, tuple)):
-            cols = cols[0]
+        return CensusDataFrame(out, index=self.index, columns=list(out.keys()))
 
-        cols = [ self.lookup(c) for c in cols]
+    def sum_m(self, *cols):
+        """Sum a set of Dataframe series and return the summed series and margin. The series must have names"""
 
-        value = sum(cols)
+        if len(cols) == 1 and isinstance(cols[0], (list, tuple)):
+            cols = cols[0]
 
-        m = np.sqrt(sum(c.m90()*c.m90() for c in cols))
+        df = self.sum_m_groups([('sum', cols)])
 
-        return value, m
+        return df['sum'], df['sum_m90']
 
     def add_sum_m(self, col_name, *cols):
         """
@@ -128,7 +300,26 @@ class CensusDataFrame(AmbryDataFrame):
 
         self[col_name], self[col_name+'_m90'] = self.sum_m(*cols)
 
+    def add_sum_m_groups(self, groups):
+        """
+        Add new columns for the sums, plus error margins, of many groups of columns. The sums
+        are all computed before any of the columns are added, and the new columns are added
+        in a single assignment, rather than inserted one sum at a time.
+
+        :param groups: A dict, or a list of pairs, of column names to the columns to sum, as for
+            sum_m_groups()
+        :return:
+        """
+        df = self.sum_m_groups(groups)
+
+        # Sums that replace existing columns keep their positions
+        for col_name in [c for c in df.columns if c in self.columns]:
+            self[col_name] = df[col_name].values
 
+        new = [c for c in df.columns if c not in self.columns]
+
+        if new:
+            self[new] = df.reindex(columns=new)
 
     def add_rse(self, *col_name):
         """
@@ -145,13 +336,55 @@ class CensusDataFrame(AmbryDataFrame):
     def sum_col_group(self, header, last):
         """Sum a contiguous group of columns, and return the sum and the new margins.  """
 
-        cols = [self.lookup(i) for i in range(header, last+1)]
+        return self.sum_m(self.column_index.range(header, last))
 
-        value = sum(cols)
+    def _ratio_operand(self, x):
+        """Return the names of the value and margin columns for an argument to ratio()"""
 
-        m = np.sqrt(np.sum(c.m90()**2 for c in cols))
+        if isinstance(x, tuple):
+            return self._column_name(x[0]), self._column_name(x[1])
+        else:
+            x = self._column_name(x)
+            return x, self.column_index.margin(x)
 
-        return value, m
+    def ratios(self, specs, subset=True):
+        """
+        Compute many ratios of numerators and denominators at once, propagating errors
+
+        :param specs: A list of (name, n, d) or (name, n, d, subset) tuples. The numerator n and
+            denominator d may be any of the forms accepted by ratio(), and subset overrides the
+            subset argument for that ratio
+        :param subset: If True, the numerators are subsets of the denominators
+        :return: A dataframe with columns <name>_rate and <name>_rate_m90 for each ratio
+        """
+        from collections import OrderedDict
+
+        names, cols, subsets = [], [], []
+
+        for spec in specs:
+            names.append(spec[0])
+            subsets.append(spec[3] if len(spec) > 3 else subset)
+            cols.extend(self._ratio_operand(spec[1]) + self._ratio_operand(spec[2]))
+
+        ci = self.column_index
+
+        a = np.asarray(self.iloc[:, [ci.position(c) for c in cols]], dtype=float)
+
+        # Every spec has four columns: numerator, numerator margin, denominator, denominator margin
+        n, n_m90, d, d_m90 = a[:, 0::4], a[:, 1::4], a[:, 2::4], a[:, 3::4]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate = np.round(n / d, 3)
+
+        rate_m = ratio_margins(rate, n_m90, d, d_m90, np.array(subsets, dtype=bool))
+
+        out = OrderedDict()
+
+        for i, name in enumerate(names):
+            out[name + '_rate'] = rate[:, i]
+            out[name + '_rate_m90'] = rate_m[:, i]
+
+        return CensusDataFrame(out, index=self.index, columns=list(out.keys()))
 
     def ratio(self, n, d, subset=True):
         """
@@ -160,6 +393,7 @@ class CensusDataFrame(AmbryDataFrame):
         Both arguments may be one of:
         * A Series, which must hav a .name property for a column in the dataset
         * A column name
+        * A column number
         * A tuple of two of either of the above.
 
         In the tuple form, the first entry is the value and the second is the 90% margin
@@ -169,48 +403,18 @@ class CensusDataFrame(AmbryDataFrame):
         :return: Tuple(Series, Series)
         """
 
-        def normalize(x):
-            if isinstance(x, tuple):
-                x, m90 = self.lookup(x[0]), self.lookup(x[1])
-            elif isinstance(x, string_types):
-                x = self.lookup(x)
-                m90 = x.m90()
-            elif isinstance(x, AmbrySeries):
-                m90 = x.m90()
-            elif isinstance(x, int):
-                x = self.lookup(x)
-                m90 = x.m90()
-
-            return x, m90
-
-        n, n_m90 = normalize(n)
-        d, d_m90 = normalize(d)
-
-        rate = np.round(n / d, 3)
-
-        if subset:
-            try:
-                # From external_documentation.acs_handbook, Appendix A, "Calculating MOEs for
-                # Derived Proportions". This is for the case when the numerator is a subset of the
-                # denominator
-                rate_m = np.sqrt(n_m90 ** 2 - ((rate ** 2) * (d_m90 ** 2))) / d
-
-            except ValueError:
-                # In the case, of a neg arg to a square root, the acs_handbook recommends using the
-                # method for "Calculating MOEs for Derived Ratios", where the numerator
-                # is not a subset of the denominator. Since our numerator is a subset, the
-                # handbook says " use the formula for derived ratios in the next section which
-                # will provide a conservative estimate of the MOE."
-                # The handbook says this case should be rare, but for this calculation, it
-                # happens about 50% of the time.
-                rate_m = np.sqrt(n_m90 ** 2 + ((rate ** 2) * (d_m90 ** 2))) / d
+        df = self.ratios([('ratio', n, d)], subset=subset)
 
-        else:
-            rate_m = np.sqrt(n_m90 ** 2 + ((rate ** 2) * (d_m90 ** 2))) / d
+        return df['ratio_rate'], df['ratio_rate_m90']
+
+    @property
+    def dimension_index(self):
+        """The DimensionIndex of the partition's table"""
+        from censuslib.dimensions import DimensionIndex
 
-        return rate, rate_m
+        return DimensionIndex.for_table(self.partition.table)
 
-    def dim_columns(self, pred):
+    def dim_columns(self, pred=None, **filters):
         """
         Return a list of columns that have a particular value for age,
         sex and race_eth. The `pred` parameter is a string of python
@@ -219,7 +423,9 @@ class CensusDataFrame(AmbryDataFrame):
 
         - sex
         - age
-        - race-eth
+        - age_min
+        - age_max
+        - race_eth
         - col_num
 
         Col_num is the number in the last three digits of the column name
@@ -228,36 +434,20 @@ class CensusDataFrame(AmbryDataFrame):
 
         - "sex == 'male' and age != 'na' "
 
+        The keyword arguments are dimension values to match, such as sex='female',
+        or age=['18-19', '20-20'].
+
         :param pred: A string of python code that is executed to find column matches.
 
         """
 
-        from censuslib.dimensions import classify
-
-
-        out_cols = []
-
-        for i, c in enumerate(self.partition.table.columns):
-            if c.name.endswith('_m90'):
-               continue
-
-            if i < 9:
-                continue
-
-            cf = classify(c)
-            cf['col_num'] = int(c.name[-3:])
-
-            if eval(pred, {}, cf):
-                out_cols.append(c.name)
-
-        return out_cols
+        return self.dimension_index.columns(pred, **filters)
 
     def __getitem__(self, key):
         """
 
         """
         from pandas import DataFrame, Series
-        from ambry.orm.exc import NotFoundError
 
 
         result = super(CensusDataFrame, self).__getitem__(key)
@@ -265,14 +455,12 @@ class CensusDataFrame(AmbryDataFrame):
         if isinstance(result, DataFrame):
             result.__class__ = CensusDataFrame
             result._dataframe = self
+            object.__setattr__(result, '_column_meta', self.column_meta)
 
         elif isinstance(result, Series):
             result.__class__ = CensusSeries
             result._dataframe = self
-            try:
-                result.ambry_column = self.partition.table.column(result.name)
-            except NotFoundError:
-                result.ambry_column = None
+            result.ambry_column = self.column_meta.get(result.name)
 
         return result
 
@@ -281,6 +469,7 @@ class CensusDataFrame(AmbryDataFrame):
         r =  super(CensusDataFrame, self).copy(deep)
         r.__class__ = CensusDataFrame
         r.partition = self.partition
+        object.__setattr__(r, '_column_meta', self.column_meta)
 
         return r
 
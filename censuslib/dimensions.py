@@ -76,19 +76,23 @@ def race(desc):
             return v
 
 
-def classify(c):
-    """Classify columns according to sex and age
+def classify_table(table):
+    """Classify all of the columns of a table according to race, sex and age, in a single pass
+    over the columns. Returns an OrderedDict of column name to the classification dict.
 
     NOTE: This doesn't work right for race when the race is in the column name, such as
     b25006. Race is only meaningful with it is in the table title.
     """
+    from collections import OrderedDict
 
     current_sex = 'na'
     current_age = 'na'
 
-    race_eth = race(c.table.description) or 'na'
+    race_eth = race(table.description) or 'na'
 
-    for c1 in c.table.columns:
+    classes = OrderedDict()
+
+    for c1 in table.columns:
 
         if 'Female' in c1.description:
             sex = 'female'
@@ -100,7 +104,6 @@ def classify(c):
         if sex:
             if sex != current_sex:
                 current_sex = sex
-                has_sex_class = True
                 current_age = 'na'
 
         age = age_range(c1)
@@ -116,18 +119,184 @@ def classify(c):
         else:
             age_min, age_max = 0, 200
 
-        if c1.name == c.name:
-            return {
-                'race_eth': race_eth,
-                'age': current_age,
-                'age_min': int(age_min),
-                'age_max': int(age_max),
-                'sex': current_sex
-            }
+        classes[c1.name] = {
+            'race_eth': race_eth,
+            'age': current_age,
+            'age_min': int(age_min),
+            'age_max': int(age_max),
+            'sex': current_sex
+        }
+
+    return classes
+
+
+def classify(c):
+    """Classify columns according to sex and age
+
+    NOTE: This doesn't work right for race when the race is in the column name, such as
+    b25006. Race is only meaningful with it is in the table title.
+    """
+
+    return classify_table(c.table).get(c.name)
+
+
+class DimensionIndex(object):
+    """The classifications of the estimate columns of a table, with an index from each
+    dimension value to the columns that have it. """
+
+    fields = ('race_eth', 'sex', 'age', 'age_min', 'age_max', 'col_num')
+
+    def __init__(self, rows, fields=None):
+        """
+        :param rows: A list of (column name, classification dict) pairs, with the keys in
+            the fields
+        :param fields: The classification keys to index, by default DimensionIndex.fields
+        """
+        from collections import defaultdict
+
+        if fields is not None:
+            self.fields = tuple(fields)
+
+        self.rows = rows
+
+        self.values = {f: defaultdict(list) for f in self.fields}
+
+        for i, (name, row) in enumerate(rows):
+            for f in self.fields:
+                self.values[f][row[f]].append(i)
+
+    @classmethod
+    def from_table(cls, table, skip=9):
+        """Build the index for a table, skipping the first `skip` columns, which are the
+        header columns, and the margin columns"""
+
+        rows = []
+
+        for i, (name, row) in enumerate(classify_table(table).items()):
+            if name.endswith('_m90') or i < skip:
+                continue
+
+            row = dict(row, col_num=int(name[-3:]))
+            rows.append((name, row))
+
+        return cls(rows)
+
+    @classmethod
+    def for_table(cls, table):
+        """Return the index for a table, building it the first time. The index is kept on
+        the table object, so it lasts as long as the table, and a table that is loaded again
+        gets a new index. """
+
+        idx = getattr(table, '_dimension_index', None)
+
+        if idx is None:
+            idx = cls.from_table(table)
+            table._dimension_index = idx
+
+        return idx
+
+    def __len__(self):
+        return len(self.rows)
+
+    def columns(self, pred=None, **filters):
+        """
+        Return the names of the columns that match a predicate and keyword filters.
+
+        :param pred: A string of python code, which is compiled once and evaluated for each
+            column, with the column's classification as the local variables.
+        :param filters: Dimension values to match. A list, tuple or set value matches any of
+            its members.
+        """
+
+        positions = None
+
+        for f, v in filters.items():
+            if f not in self.values:
+                raise KeyError("Unknown dimension '{}'".format(f))
+
+            if isinstance(v, (list, tuple, set)):
+                matches = set(i for e in v for i in self.values[f].get(e, []))
+            else:
+                matches = set(self.values[f].get(v, []))
+
+            positions = matches if positions is None else positions & matches
+
+        if positions is None:
+            positions = range(len(self.rows))
+        else:
+            positions = sorted(positions)
+
+        if pred:
+            code = compile(pred, '<pred>', 'eval')
+            positions = [i for i in positions if eval(code, {}, self.rows[i][1])]
+
+        return [self.rows[i][0] for i in positions]
+
+
+class DimensionCatalog(object):
+    """The classifications of the estimate columns of all of the tables in a schema, with an
+    index from each dimension value to the (table, column) pairs that have it. """
+
+    fields = DimensionIndex.fields + ('table',)
+
+    def __init__(self, rows):
+        """
+        :param rows: A list of ((table name, column name), classification dict) pairs, with
+            the keys in DimensionCatalog.fields
+        """
+
+        self.index = DimensionIndex(rows, self.fields)
+
+    @classmethod
+    def from_tables(cls, tables):
+        """Classify the columns of all of the tables"""
+
+        rows = []
+
+        for table in tables:
+            for name, row in DimensionIndex.from_table(table).rows:
+                rows.append(((table.name, name), dict(row, table=table.name)))
+
+        return cls(rows)
+
+    @property
+    def rows(self):
+        return self.index.rows
+
+    def __len__(self):
+        return len(self.index)
+
+    def columns(self, pred=None, **filters):
+        """Return the (table, column) pairs that match a predicate and keyword filters, as for
+        DimensionIndex.columns()"""
+        return self.index.columns(pred, **filters)
 
+    @property
+    def tables(self):
+        """The names of the tables in the catalog"""
+        return sorted(self.index.values['table'].keys())
 
+    def to_data(self):
+        """Return the catalog as data for JSON"""
+        return [[table, column, row] for (table, column), row in self.rows]
 
+    @classmethod
+    def from_data(cls, rows):
+        return cls([((table, column), {str(k): v for k, v in row.items()})
+                    for table, column, row in rows])
 
+    @staticmethod
+    def path(key):
+        """The path of the catalog saved in a cache under a key"""
+        from .util import versioned_cache_path
 
+        return versioned_cache_path('dimensions', key, '.json')
 
+    @classmethod
+    def cached(cls, cache, key, tables_f):
+        """Load the catalog saved in a cache under a key, such as the versioned id of the
+        bundle's dataset, or build it from the tables returned by tables_f() and save it. """
+        from .util import cached_json
 
+        return cached_json(cache, cls.path(key), lambda: cls.from_tables(tables_f()),
+                           cls.to_data, cls.from_data)
@@ -0,0 +1,299 @@
+"""
+Bulk downloading of source files into the library download cache.
+
+Files are fetched concurrently, partial downloads are resumed with HTTP range
+requests, and a manifest of the size and checksum of each completed file is kept
+in the cache, so files that have already been verified are skipped on later runs.
+
+"""
+
+import threading
+
+MANIFEST_PATH = '_censuslib/download_manifest.json'
+
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds between progress messages for a download
+PROGRESS_INTERVAL = 10
+
+
+def cache_path(url):
+    """Return the path of the file for a URL in the download cache. This must match
+    the path that ambry_sources.download uses, so get_source() will find the file. """
+    import os.path
+    import hashlib
+    from urlparse import urlparse
+
+    parsed = urlparse(str(url))
+
+    path = os.path.join(parsed.netloc, parsed.path.strip('/'))
+
+    # If there is a query, hash it and add it to the path
+    if parsed.query:
+        path = os.path.join(path, hashlib.sha224(parsed.query).hexdigest())
+
+    return path
+
+
+def file_md5(cache, path):
+    """Return the hex MD5 checksum of a file in the cache"""
+    import hashlib
+
+    h = hashlib.md5()
+
+    with cache.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class DownloadManifest(object):
+    """A record of the files that have been completely downloaded into a cache, with
+    their sizes and checksums. The manifest is stored as JSON in the cache itself. """
+
+    def __init__(self, cache, path=MANIFEST_PATH):
+
+        self.cache = cache
+        self.path = path
+        self._lock = threading.Lock()
+
+        self.reload()
+
+    def reload(self):
+        """Read the manifest again, to pick up downloads recorded by other processes"""
+        from .util import load_json
+
+        with self._lock:
+            self.entries = load_json(self.cache, self.path, {})
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def is_verified(self, url, check_md5=False):
+        """Return True if the file for a URL is in the cache with the size, and optionally
+        the checksum, recorded in the manifest"""
+
+        e = self.entries.get(url)
+
+        if not e or not self.cache.exists(e['path']):
+            return False
+
+        if self.cache.getsize(e['path']) != e['size']:
+            return False
+
+        if check_md5 and file_md5(self.cache, e['path']) != e['md5']:
+            return False
+
+        return True
+
+    def record(self, url, path):
+        """Record a completed download, and save the manifest. The saved manifest is read
+        again and merged under a lock, so entries recorded by other processes are kept. """
+        from .util import update_json
+
+        entry = dict(path=path, size=self.cache.getsize(path), md5=file_md5(self.cache, path))
+
+        def merge(entries):
+            entries[url] = entry
+            return entries
+
+        with self._lock:
+            self.entries = update_json(self.cache, self.path, merge, {}, indent=2, sort_keys=True)
+
+        return entry
+
+
+def fetch(url, cache, manifest, timeout=60, log=None):
+    """Download a single URL into the cache, resuming a partial download if there is one.
+    Returns the manifest entry for the file.
+
+    A lock on the URL's file, shared between processes, is held for the download, so a URL is
+    only fetched by one process at a time. A process that waited for the lock finds the file
+    in the manifest, and doesn't fetch it again. """
+    from .util import file_lock
+
+    with file_lock(cache, cache_path(url)):
+        manifest.reload()
+
+        if manifest.is_verified(url):
+            return manifest.get(url)
+
+        return _download(url, cache, manifest, timeout, log)
+
+
+def _download(url, cache, manifest, timeout, log):
+    import time
+    import urllib2
+    from os.path import dirname
+
+    if not url.startswith(('http://', 'https://')):
+        # Not something we can resume; let ambry_sources handle it.
+        from ambry_sources import download
+
+        path, _ = download(url, cache)
+        return manifest.record(url, path)
+
+    path = cache_path(url)
+    part_path = path + '.part'
+
+    # The ETag or Last-Modified date of the response that the part file was started from,
+    # so a resumed request can ask for the rest of the same version of the file
+    validator_path = part_path + '.validator'
+
+    cache.makedir(dirname(path), recursive=True, allow_recreate=True)
+
+    # A file that is in the cache but not the manifest may have been left incomplete
+    # by an earlier download, so try to resume it.
+    if cache.exists(path):
+        if cache.exists(part_path):
+            cache.remove(part_path)
+        cache.rename(path, part_path)
+
+    validator = cache.getcontents(validator_path) if cache.exists(validator_path) else None
+
+    if cache.exists(part_path) and not validator:
+        # Without a validator, there is no way to tell whether the rest of the file on
+        # the server belongs with what we have, so start over.
+        cache.remove(part_path)
+
+    offset = cache.getsize(part_path) if cache.exists(part_path) else 0
+
+    request = urllib2.Request(url)
+
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+        # If the file has changed, the server ignores the range and sends all of it
+        request.add_header('If-Range', validator)
+
+    try:
+        r = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 416 and offset:
+            # The range starts at the end of the file, so the partial file is actually complete
+            cache.rename(part_path, path)
+            return _record(url, path, cache, manifest, validator_path)
+        raise
+
+    try:
+        if offset and r.getcode() == 206:
+            mode = 'ab'
+            expected = offset
+        else:
+            # The server ignored the range header, or the file has changed, so start over.
+            mode = 'wb'
+            expected = 0
+
+            validator = _response_validator(r.info())
+
+            if validator:
+                cache.setcontents(validator_path, validator)
+            elif cache.exists(validator_path):
+                cache.remove(validator_path)
+
+        length = r.info().getheader('Content-Length')
+        expected = expected + int(length) if length is not None else None
+
+        size = offset if mode == 'ab' else 0
+        last_log = time.time()
+
+        with cache.open(part_path, mode) as f:
+            for chunk in iter(lambda: r.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                size += len(chunk)
+
+                if log and time.time() - last_log >= PROGRESS_INTERVAL:
+                    log('Downloading {}; {} bytes'.format(url, size))
+                    last_log = time.time()
+    finally:
+        r.close()
+
+    size = cache.getsize(part_path)
+
+    if expected is not None and size != expected:
+        # Leave the part file, so the next run will resume it.
+        raise IOError("Incomplete download of {}: got {} bytes, expected {}".format(url, size, expected))
+
+    cache.rename(part_path, path)
+
+    return _record(url, path, cache, manifest, validator_path)
+
+
+def _response_validator(info):
+    """Return the validator to send in an If-Range header to resume a response: its ETag,
+    or its Last-Modified date, since a weak ETag can't be used in If-Range"""
+
+    etag = info.getheader('ETag')
+
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return info.getheader('Last-Modified')
+
+
+def _record(url, path, cache, manifest, validator_path):
+
+    entry = manifest.record(url, path)
+
+    if cache.exists(validator_path):
+        cache.remove(validator_path)
+
+    return entry
+
+
+def download_all(urls, cache, processes=4, check_md5=False, log=None):
+    """Download a collection of URLs into a cache, with up to `processes` concurrent downloads.
+
+    Duplicate URLs are downloaded once, and URLs for files already verified against the
+    manifest are skipped.
+
+    :param urls: An iterable of URLs
+    :param cache: A filesystem, such as library.download_cache
+    :param processes: Maximum number of concurrent downloads
+    :param check_md5: If True, also verify the checksums of previously downloaded files
+    :param log: A function that takes a string, for progress messages
+    :return: The DownloadManifest
+    """
+    from multiprocessing.pool import ThreadPool
+
+    log = log or (lambda m: None)
+
+    manifest = DownloadManifest(cache)
+
+    seen = set()
+    todo = []
+
+    for url in urls:
+        if url in seen:
+            continue
+
+        seen.add(url)
+
+        if manifest.is_verified(url, check_md5):
+            log("Already downloaded: {}".format(url))
+        else:
+            todo.append(url)
+
+    def _fetch(url):
+        log("Downloading: {}".format(url))
+        fetch(url, cache, manifest, log=log)
+        return url
+
+    if not todo:
+        return manifest
+
+    pool = ThreadPool(max(1, min(processes, len(todo))))
+
+    try:
+        for url in pool.imap_unordered(_fetch, todo):
+            log("Downloaded: {}".format(url))
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return manifest
@@ -1,16 +1,24 @@
 # Table generators
 
 from ambry.util import memoize
+from collections import Counter
+from .transforms import JamValueMixin
 
-class ACS09TableRowGenerator(object):
-    """Generate table rows by combining multuple state files, slicing out 
-    an individual table, and merging the estimates and margins"""
-    
-    def __init__(self, bundle, source):
+# Number of rows that are read from the sequence files and sliced at once
+DEFAULT_BLOCK_SIZE = 5000
+
+# Number of sliced blocks that a pool worker can send ahead of the generator
+QUEUE_BLOCKS = 2
+
+class ACS09StateFileReader(object):
+    """Read the estimate and margin files of a sequence for every state, join them and
+    slice blocks of the joined rows. This is the base of the table and sequence row
+    generators, which differ in how the blocks are sliced. """
+
+    def __init__(self, bundle, processes=None, block_size=None):
 
         from ambry.exc import NotFoundError
 
-        self.source = source
         self.bundle = bundle
         self.library = self.bundle.library
         self.year = int(self.bundle.year)
@@ -27,6 +35,22 @@ class ACS09TableRowGenerator(object):
 
         self.limited_run = self.bundle.limited_run
 
+        # Number of processes to use for parsing the state files. None or 1 parses
+        # them serially in this process.
+        self.processes = processes if processes is not None else getattr(bundle, 'generator_processes', None)
+
+        self.block_size = block_size or getattr(bundle, 'generator_block_size', None) or DEFAULT_BLOCK_SIZE
+
+        # Codes for the jam values, for the jam_flags column
+        self.jam_map = getattr(bundle, 'jam_map', JamValueMixin.jam_map)
+
+        # Save the output for each state as it is finished, so a failed run can resume. Limited
+        # runs only read part of each state, so they are never checkpointed.
+        self.checkpoints = getattr(bundle, 'generator_checkpoints', False) and not self.limited_run
+
+        # Counts of the estimate and margin rows that were joined, or that had no partner
+        self.join_counts = Counter()
+
         self._states = None
 
     @property
@@ -53,19 +77,11 @@ class ACS09TableRowGenerator(object):
         else:
             return self._states
 
-    def generate_source_specs(self):
-        """Generate fake source specs for all of the files that underlie this table, which
-        are actually the same for every table. """
+    def generate_source_specs(self, sequence):
+        """Generate fake source specs for all of the state files of a sequence"""
 
         from ambry_sources import SourceSpec
 
-        table = self.source.dest_table
-
-        if isinstance(table, str):
-            table = self.table(table)
-
-        sequence = int(table.data['sequence'])
-
         for stusab, state_id, state_name in self.states:
             file = "{}{}{}{:04d}000.txt".format(self.year, self.release,
                                                 stusab.lower(), sequence)
@@ -98,69 +114,638 @@ class ACS09TableRowGenerator(object):
 
                 yield (spec1, spec2)
 
+    @property
+    @memoize
+    def zip_index(self):
+        from .zipindex import ZipIndex
 
+        return ZipIndex(self.library.download_cache)
 
-    def __iter__(self):
+    def _get_sources(self, spec1, spec2):
+        """Return row iterators for the estimate and margin files, read straight from
+        the downloaded archives"""
+
+        return (self.zip_index.rows(spec1.url, spec1.file),
+                self.zip_index.rows(spec2.url, spec2.file))
+
+    def iter_sliced_blocks(self, slicer, sequence, checkpoint_name):
+        """Yield (n_rows, sliced) for blocks of estimate and margin rows from all of the state
+        files of a sequence, where sliced is the result of slicer.slice_block(). If
+        self.processes is greater than one, the state files are parsed in a process pool, but
+        the blocks are still yielded in the same order as the serial path.
+
+        If checkpoints are enabled, the blocks for each state are saved as the state is
+        finished, and states that were finished by an earlier, failed run are read back from
+        their checkpoints rather than being parsed again. The checkpoints are removed when
+        all of the states have been generated. """
+        from multiprocessing import current_process
+
+        limit = 10000 if self.limited_run else None
+
+        checkpoints = None
+
+        if self.checkpoints:
+            checkpoints = StateCheckpoints(self.bundle.build_fs, checkpoint_name, slicer, self.zip_index)
+
+        # Daemonic processes, such as the workers of a multi-process build, can't have children
+        if self.processes and self.processes > 1 and not current_process().daemon:
+            states = self._iter_state_blocks_parallel(slicer, sequence, limit, checkpoints)
+        else:
+            states = self._iter_state_blocks_serial(slicer, sequence, limit, checkpoints)
+
+        blocks = ((n, sliced) for spec, state_blocks in states for n, sliced in state_blocks)
+
+        for n, sliced in limit_blocks(blocks, slicer, limit):
+            yield n, sliced
+
+        if checkpoints:
+            checkpoints.clear()
+
+    def _add_join_counts(self, spec, counts):
+        """Accumulate the counts from joining one estimate and margin pair, and warn about
+        unmatched rows"""
+
+        self.join_counts.update(counts)
+
+        if counts['unmatched_estimates'] or counts['unmatched_margins']:
+            self.bundle.error("{} {}: {} estimate rows and {} margin rows had no matching LOGRECNO"
+                              .format(spec.url, spec.file, counts['unmatched_estimates'],
+                                      counts['unmatched_margins']))
+
+    def _slice_state(self, spec1, spec2, slicer, limit):
+
+        s1, s2 = self._get_sources(spec1, spec2)
+
+        counts = Counter()
+
+        for n, sliced in slice_sources(s1, s2, slicer, self.block_size, limit, counts):
+            yield n, sliced
+
+        self._add_join_counts(spec1, counts)
+
+    def _iter_state_blocks_serial(self, slicer, sequence, limit, checkpoints):
+        """Yield (spec, blocks) for each state file pair"""
+
+        for spec1, spec2 in self.generate_source_specs(sequence):
+            if checkpoints and checkpoints.exists(spec1):
+                yield spec1, checkpoints.load(spec1)
+            elif checkpoints:
+                yield spec1, checkpoints.save(spec1, self._slice_state(spec1, spec2, slicer, limit))
+            else:
+                yield spec1, self._slice_state(spec1, spec2, slicer, limit)
+
+    def _iter_state_blocks_parallel(self, slicer, sequence, limit, checkpoints):
+        """Yield (spec, blocks) for each state file pair, parsing the files in a process pool.
+
+        The workers send their blocks back one at a time, through a bounded queue for each
+        state, so a worker that gets ahead of the consumer waits, rather than holding the
+        rest of its state in memory. Memory use depends on the block size and the number of
+        processes, not on the size of the states. """
+        from multiprocessing import Pool, Manager
+        from collections import deque
+
+        cache_path = self.library.download_cache.getsyspath('/')
+
+        # States that are queued for the pool; only the ones that are running hold any blocks
+        window = 2 * self.processes
+
+        manager = Manager()
+        pool = Pool(self.processes)
+
+        try:
+            pending = deque()
+
+            def pop():
+                spec, queue, result = pending.popleft()
+
+                if queue is None:
+                    return spec, checkpoints.load(spec)
+
+                blocks = self._receive_blocks(spec, queue, result)
+
+                return spec, checkpoints.save(spec, blocks) if checkpoints else blocks
+
+            for spec1, spec2 in self.generate_source_specs(sequence):
+                if checkpoints and checkpoints.exists(spec1):
+                    pending.append((spec1, None, None))
+                else:
+                    queue = manager.Queue(QUEUE_BLOCKS)
+                    pending.append((spec1, queue, pool.apply_async(_slice_source_pair,
+                                    ((cache_path, spec1, spec2, slicer, self.block_size, limit, queue),))))
+
+                if len(pending) >= window:
+                    yield pop()
+
+            while pending:
+                yield pop()
+
+            pool.close()
+
+        finally:
+            pool.terminate()
+            pool.join()
+            manager.shutdown()
+
+    def _receive_blocks(self, spec, queue, result):
+        """Yield the blocks that a pool worker sends for a state, then record its join counts"""
+        from Queue import Empty
+
+        # Set when the worker has returned, so everything it sent is already on the queue
+        finished = False
+
+        while True:
+            try:
+                msg = queue.get_nowait() if finished else queue.get(timeout=1)
+            except Empty:
+                if finished:
+                    raise RuntimeError("Worker for {} {} exited without finishing"
+                                       .format(spec.url, spec.file))
+
+                if result.ready():
+                    # Raises the worker's exception, if it had one. Otherwise, the worker may
+                    # have sent the rest of its blocks just after the timeout, so drain the queue.
+                    result.get()
+                    finished = True
+
+                continue
+
+            if msg[0] == 'done':
+                self._add_join_counts(spec, msg[1])
+                return
+
+            n, sliced = msg[1:]
+
+            yield n, sliced
+
+
+class ACS09TableRowGenerator(ACS09StateFileReader):
+    """Generate table rows by combining multuple state files, slicing out 
+    an individual table, and merging the estimates and margins"""
+
+    def __init__(self, bundle, source, processes=None, block_size=None):
+
+        super(ACS09TableRowGenerator, self).__init__(bundle, processes=processes, block_size=block_size)
+
+        self.source = source
+
+    @property
+    def table(self):
+        """The destination table for the source"""
 
-        from ambry_sources import get_source
-        from itertools import izip, chain
-        from ambry.etl import Slice
-        from ambry.orm import Column
-        from ambry.bundle.process import CallInterval
-        
         table = self.source.dest_table
-        
+
         if isinstance(table, str):
-            table = self.table(table)
+            table = self.bundle.table(table)
+
+        return table
+
+    def generate_source_specs(self, sequence=None):
+        """Generate fake source specs for all of the files that underlie this table, which
+        are actually the same for every table. """
+
+        if sequence is None:
+            sequence = int(self.table.data['sequence'])
+
+        return super(ACS09TableRowGenerator, self).generate_source_specs(sequence)
+
+    def _iter_table_blocks(self, slicer):
+        return self.iter_sliced_blocks(slicer, int(self.table.data['sequence']), self.table.name)
+
+    def __iter__(self):
+
+        slicer = TableSlicer(self.table, self.header_cols)
+
+        yield slicer.headers
+
+        for n, block in self._iter_table_blocks(slicer):
+            for row in decode_block(block, len(slicer.header_positions), self.jam_map):
+                yield row
+
+    def batches(self, size=None):
+        """Yield the table's rows as RecordBatches of `size` rows, rather than as tuples. All
+        but the last batch have exactly `size` rows. The default size is the block size. """
+
+        slicer = TableSlicer(self.table, self.header_cols)
+
+        return batch_blocks(self._iter_table_blocks(slicer), size or self.block_size,
+                            slicer.headers, len(slicer.header_positions), self.jam_map)
+
+
+class ACS09SequenceRowGenerator(ACS09StateFileReader):
+    """Generate rows for all of the tables in a sequence at once. The state
+    files for the sequence are read only once, and each pair of estimate and
+    margin rows is sliced for every table in the sequence.
+
+    Iterating yields (table_name, row) tuples; the headers for each table are
+    in the `slicers` dict. """
+
+    def __init__(self, bundle, sequence, tables=None, processes=None, block_size=None):
+
+        super(ACS09SequenceRowGenerator, self).__init__(bundle, processes=processes,
+                                                        block_size=block_size)
+
+        self.sequence = int(sequence)
+
+        if tables is None:
+            tables = [self.bundle.table(table_id)
+                      for table_id in self.bundle.table_catalog.sequence(self.sequence)]
+
+        self.tables = tables
+
+    @property
+    @memoize
+    def slicers(self):
+        """A dict of TableSlicers, keyed by table name"""
+        return {t.name: TableSlicer(t, self.header_cols) for t in self.tables}
+
+    def __iter__(self):
+
+        slicer = SequenceSlicer(self.slicers.items())
+
+        for n, blocks in self.iter_sliced_blocks(slicer, self.sequence,
+                                                 'sequence{:04d}'.format(self.sequence)):
+            for table_name, block in blocks:
+                n_header = len(self.slicers[table_name].header_positions)
+
+                for row in decode_block(block, n_header, self.jam_map):
+                    yield table_name, row
+
+
+class TableSlicer(object):
+    """Slice the columns for a single table out of blocks of estimate and margin rows
+    from a sequence file. The sliced rows have the header columns ( stusab, logrecno,
+    etc ) followed by the table's estimates interleaved with the margins. The headers
+    are for the rows after decode_block() has added the jam_flags column. """
+
+    def __init__(self, table, header_cols):
+        from ambry.orm import Column
 
         start = int(table.data['start'])
         length = int(table.data['length'])
 
-        slca_str = ','.join(str(e[4]) for e in self.header_cols)
-        slcb_str =  "{}:{}".format(start-1, start+length-1)
-        
-        # Slice for the stusab, logrecno, etc. 
-        slca, slc_code = Slice.make_slicer(slca_str)
-        # Slice for the data columns
-        slcb, slc_code = Slice.make_slicer(slcb_str)
-        
-        columns = [ c.name for c in table.columns ]
+        # Positions of the stusab, logrecno, etc.
+        self.header_positions = [int(e[4]) for e in header_cols]
+        # Positions of the stusab and logrecno, for joining the estimates to the margins
+        self.key_positions = tuple(int(e[4]) for e in header_cols if e[0] in ('STUSAB', 'LOGRECNO'))
+        # Range of the data columns
+        self.data_start, self.data_end = start-1, start+length-1
+
+        columns = [c.name for c in table.columns]
 
         # Columns before the first data column, by removing the
-        # data columns, which are presumed to all be at the end. 
-        preamble_cols = columns[:-2*len(slcb(range(1,300)))]
-        data_columns =  columns[len(preamble_cols):]
-        
-        header_cols = [e[0] for e in self.header_cols]
+        # data columns, which are presumed to all be at the end.
+        preamble_cols = columns[:-2*length]
+        data_columns = columns[len(preamble_cols):]
 
         # A few sanity checks
         assert preamble_cols[-1] == 'jam_flags'
         assert data_columns[0][-3:] == '001'
         assert data_columns[1][-3:] == 'm90'
 
-        all_cols =  [ Column.mangle_name(c) for c in header_cols + data_columns]
+        self.headers = [Column.mangle_name(c) for c in [e[0] for e in header_cols] + ['jam_flags'] +
+                        data_columns]
+
+    @property
+    def signature(self):
+        """A string that changes if the slicer would produce different output"""
+        return repr((self.header_positions, self.data_start, self.data_end, self.headers))
+
+    def slice_block(self, e, m):
+        """Slice a block of rows, given as 2-D arrays of estimate and margin rows, returning a
+        2-D array with the header columns and the interleaved estimates and margins. """
+        import numpy as np
+
+        h = len(self.header_positions)
+
+        estimates = e[:, self.data_start:self.data_end]
+        margins = m[:, self.data_start:self.data_end]
+
+        out = np.empty((e.shape[0], h + 2*estimates.shape[1]), dtype=e.dtype)
+
+        out[:, :h] = e[:, self.header_positions]
+        out[:, h::2] = estimates
+        out[:, h+1::2] = margins
+
+        return out
+
+    def head(self, sliced, n):
+        """Return the first n rows of a sliced block"""
+        return sliced[:n]
+
+
+class SequenceSlicer(object):
+    """Apply the slicers for all of the tables in a sequence to a block of rows, returning
+    a list of (table_name, block) tuples"""
+
+    def __init__(self, slicers):
+        self.slicers = list(slicers)
+        self.key_positions = self.slicers[0][1].key_positions
+
+    @property
+    def signature(self):
+        return repr([(table_name, slicer.signature) for table_name, slicer in self.slicers])
+
+    def slice_block(self, e, m):
+        return [(table_name, slicer.slice_block(e, m)) for table_name, slicer in self.slicers]
+
+    def head(self, sliced, n):
+        return [(table_name, block[:n]) for table_name, block in sliced]
+
+
+class StateCheckpoints(object):
+    """Saved blocks of sliced rows for each of the state file pairs that a generator has
+    finished. A checkpoint is only created when all of the blocks for a state have been
+    written, so an interrupted state is parsed again from the start. The checkpoints are
+    stored under a directory named for the slicer signature, and each is named for the md5
+    of its archive, so they are not used if the table layout changes or the archive is
+    downloaded again with different contents. """
 
-        yield all_cols
+    def __init__(self, fs, name, slicer, zip_index):
+        import hashlib
 
-        def progress(read_len, total_len, source_name):
-            self.bundle.log('Downloading {}; {} bytes'.format(source_name, total_len))
+        self.fs = fs
+        self.zip_index = zip_index
+        self.dir = 'checkpoints/{}-{}'.format(name, hashlib.md5(slicer.signature).hexdigest()[:12])
 
-        cache = self.library.download_cache
+    def path(self, spec):
+        from os.path import basename, splitext
 
-        row_n = 0
-        for spec1, spec2 in self.generate_source_specs():
+        # The file name is the same for the small and large area archives, so include the url
+        return '{}/{}-{}-{}.pkl'.format(self.dir, splitext(basename(spec.url))[0], spec.file[1:-4],
+                                        self.zip_index.archive(spec.url)['md5'][:12])
 
-            s1 = get_source(spec1, cache, callback=CallInterval(progress, 10, source_name=spec1.url))
-            s2 = get_source(spec2, cache, callback=CallInterval(progress, 10, source_name=spec1.url))
+    def exists(self, spec):
+        return self.fs.exists(self.path(spec))
 
-            for i, (row1, row2) in enumerate(izip(s1, s2)):
-                # Interleave the slices of the of the data rows, prepend
-                # the stusab, logrecno, etc.
+    def load(self, spec):
+        """Yield the saved blocks for a state"""
+        import cPickle as pickle
 
-                row_n += 1
-                if self.limited_run and row_n > 10000:
+        with self.fs.open(self.path(spec), 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
                     return
 
-                yield slca(row1)+tuple(chain(*zip(slcb(row1),slcb(row2))))
-                    
-        
\ No newline at end of file
+    def save(self, spec, blocks):
+        """Pass through the blocks for a state, saving them. The checkpoint is only
+        created if all of the blocks are consumed. If the blocks are not all consumed, or
+        reading them fails, the partial temp file is removed. """
+        import cPickle as pickle
+
+        self.fs.makedir(self.dir, recursive=True, allow_recreate=True)
+
+        path = self.path(spec)
+        tmp_path = path + '.tmp'
+
+        completed = False
+
+        try:
+            with self.fs.open(tmp_path, 'wb') as f:
+                for block in blocks:
+                    pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+                    yield block
+
+            self.fs.rename(tmp_path, path)
+            completed = True
+
+        finally:
+            if not completed and self.fs.exists(tmp_path):
+                self.fs.remove(tmp_path)
+
+    def clear(self):
+        if self.fs.exists(self.dir):
+            self.fs.removedir(self.dir, recursive=True, force=True)
+
+
+class RecordBatch(object):
+    """A batch of table rows in columnar form. The header columns ( stusab, logrecno, etc )
+    are kept as a 2-D object array, the jam flags as a list, and the estimates and margins
+    as a 2-D float array, with NaN for jam values. The column names are the same as the
+    headers from the table row generator. """
+
+    def __init__(self, headers, header_values, data, jam_flags=None):
+        self.headers = headers
+        self.header_values = header_values
+        self.data = data
+        self.jam_flags = jam_flags
+
+        self._positions = {name: i for i, name in enumerate(headers)}
+
+    @classmethod
+    def from_block(cls, headers, block, n_header, jam_map=None):
+        """Create a batch from a block of sliced rows"""
+        from .transforms import decode_jams, rle
+
+        data, mask, jams = decode_jams(block[:, n_header:], jam_map or JamValueMixin.jam_map)
+
+        return cls(headers, block[:, :n_header], data, [rle(j) if j else None for j in jams])
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def columns(self):
+        """A list of the column arrays, in the same order as the headers"""
+        import numpy as np
+
+        n_header = self.header_values.shape[1]
+        return ([self.header_values[:, i] for i in range(n_header)] +
+                [np.array(self.jam_flags, dtype=object)] +
+                [self.data[:, i] for i in range(self.data.shape[1])])
+
+    def __getitem__(self, name):
+        import numpy as np
+
+        i = self._positions[name]
+        n_header = self.header_values.shape[1]
+
+        if i < n_header:
+            return self.header_values[:, i]
+        elif i == n_header:
+            return np.array(self.jam_flags, dtype=object)
+        else:
+            return self.data[:, i - n_header - 1]
+
+    def to_dataframe(self):
+        import pandas as pd
+        from collections import OrderedDict
+
+        return pd.DataFrame(OrderedDict(zip(self.headers, self.columns)), columns=self.headers)
+
+
+def decode_block(block, n_header, jam_map):
+    """Convert the data values of a sliced block to floats, with None for jam values, and
+    add the jam_flags column after the header columns. Returns the rows as tuples, as the
+    jam_float and jam_values transforms would make them. """
+    import numpy as np
+    from .transforms import decode_jams, rle
+
+    data, mask, jams = decode_jams(block[:, n_header:], jam_map)
+
+    out = np.empty((block.shape[0], block.shape[1] + 1), dtype=object)
+
+    out[:, :n_header] = block[:, :n_header]
+    out[:, n_header] = [rle(j) if j else None for j in jams]
+    out[:, n_header+1:] = data
+
+    if mask is not None:
+        out[:, n_header+1:][mask] = None
+
+    return [tuple(row) for row in out.tolist()]
+
+
+def batch_blocks(blocks, size, headers, n_header, jam_map=None):
+    """Regroup (n_rows, block) sliced table blocks into RecordBatches of exactly `size` rows,
+    except for the last batch, which has the rest. """
+    import numpy as np
+
+    pending = []
+    n_pending = 0
+
+    for n, block in blocks:
+        pending.append(block)
+        n_pending += n
+
+        if n_pending < size:
+            continue
+
+        block = np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+        for i in range(0, len(block) - size + 1, size):
+            yield RecordBatch.from_block(headers, block[i:i+size], n_header, jam_map)
+
+        rest = block[len(block) - len(block) % size:]
+        pending = [rest] if len(rest) else []
+        n_pending = len(rest)
+
+    if pending:
+        block = np.concatenate(pending) if len(pending) > 1 else pending[0]
+        yield RecordBatch.from_block(headers, block, n_header, jam_map)
+
+
+def merge_join(s1, s2, key_positions, counts=None):
+    """Join the rows of an estimate and a margin source on (STUSAB, LOGRECNO), yielding
+    (row1, row2) pairs. Both sources must be sorted by LOGRECNO, as the sequence files are,
+    so the join only holds one row from each source at a time. Rows that have no partner
+    are dropped, and counted in the 'unmatched_estimates' and 'unmatched_margins' entries
+    of `counts`. """
+
+    a, b = key_positions
+
+    def key(row):
+        return row[a].upper(), int(row[b])
+
+    matched = unmatched_estimates = unmatched_margins = 0
+
+    i1, i2 = iter(s1), iter(s2)
+
+    row1, row2 = next(i1, None), next(i2, None)
+
+    last_key = None
+
+    try:
+        while row1 is not None and row2 is not None:
+
+            # Fast path, for when the files are aligned, which is nearly always.
+            if row1[b] == row2[b] and row1[a] == row2[a]:
+                matched += 1
+                yield row1, row2
+                row1, row2 = next(i1, None), next(i2, None)
+                continue
+
+            k1, k2 = key(row1), key(row2)
+
+            if last_key is not None and min(k1, k2) < last_key:
+                raise ValueError("Sequence files are not sorted by LOGRECNO at {}".format(min(k1, k2)))
+
+            last_key = min(k1, k2)
+
+            if k1 == k2:
+                matched += 1
+                yield row1, row2
+                row1, row2 = next(i1, None), next(i2, None)
+            elif k1 < k2:
+                unmatched_estimates += 1
+                row1 = next(i1, None)
+            else:
+                unmatched_margins += 1
+                row2 = next(i2, None)
+
+        while row1 is not None:
+            unmatched_estimates += 1
+            row1 = next(i1, None)
+
+        while row2 is not None:
+            unmatched_margins += 1
+            row2 = next(i2, None)
+
+    finally:
+        if counts is not None:
+            counts['matched'] += matched
+            counts['unmatched_estimates'] += unmatched_estimates
+            counts['unmatched_margins'] += unmatched_margins
+
+
+def slice_sources(s1, s2, slicer, block_size, limit=None, counts=None):
+    """Read blocks of up to block_size joined rows from an estimate and a margin source, and
+    yield (n_rows, sliced) for each block, where sliced is the result of slicer.slice_block()"""
+    import numpy as np
+    from itertools import islice
+
+    pairs = islice(merge_join(s1, s2, slicer.key_positions, counts), limit)
+
+    while True:
+        block = list(islice(pairs, block_size))
+
+        if not block:
+            return
+
+        e = np.array([row1 for row1, row2 in block], dtype=object)
+        m = np.array([row2 for row1, row2 in block], dtype=object)
+
+        if e.ndim != 2 or m.shape != e.shape:
+            raise ValueError("Estimate and margin rows must all have the same number of columns")
+
+        yield len(block), slicer.slice_block(e, m)
+
+
+def limit_blocks(blocks, slicer, limit=None):
+    """Pass through (n_rows, sliced) blocks until there have been `limit` rows, trimming the
+    last block with slicer.head() so no more than `limit` rows are yielded"""
+
+    row_n = 0
+
+    for n, sliced in blocks:
+        if limit and row_n + n > limit:
+            n = limit - row_n
+            sliced = slicer.head(sliced, n)
+
+        yield n, sliced
+
+        row_n += n
+
+        if limit and row_n >= limit:
+            return
+
+
+def _slice_source_pair(args):
+    """Process pool worker. Read an estimate and margin file pair from the download cache,
+    and put each sliced block on the queue, followed by the join counts."""
+    from fs.opener import fsopendir
+    from .zipindex import ZipIndex
+
+    cache_path, spec1, spec2, slicer, block_size, limit, queue = args
+
+    zip_index = ZipIndex(fsopendir(cache_path))
+
+    s1 = zip_index.rows(spec1.url, spec1.file)
+    s2 = zip_index.rows(spec2.url, spec2.file)
+
+    counts = Counter()
+
+    for n, sliced in slice_sources(s1, s2, slicer, block_size, limit, counts):
+        queue.put(('block', n, sliced))
+
+    queue.put(('done', counts))
@@ -42,6 +42,11 @@ Step 4: Update the datatype based on a single ingestion
 This will run for a while, because the California file is big. A big file should have the full
 range of values for each column, so it is better for determining column datatypes
 
+Alternatively, give a number of processes to read the geofiles for all of the states in
+parallel, which is faster and sees all of the values for every state:
+
+    $ bambry exec meta_update_source_types 8
+
 Run 'bambry dump -C' and verify that not all of the colums have the same datatype.
 
 Step 5: Now, sync out and build the bundle
@@ -62,6 +67,11 @@ to determine which columns are used and which are not. Then it will create new s
     $ bambry exec meta_build_reduced_schemas
     $ bambry sync -o
 
+To scan the ingested state files in parallel, rather than the built partition, give
+the number of processes:
+
+    $ bambry exec meta_build_reduced_schemas 8
+
 Run 'bambry dump -t' to verify there are many more tables
 
 
@@ -69,17 +79,447 @@ Step 7: Build again with stage 2, reduced schemas.
 
     bambry -m build
 
+Fixed width sources
+===================
+
+The geofiles are also published as fixed width .txt files. GeofileRowGenerator reads
+those directly from the downloaded archives, using the start and width of each column from
+the source schema, which is much faster than the CSV path. To use it, import it in the
+bundle.py, then set the geofile sources to use the generator:
+
+    $ bambry exec meta_fixed_width_sources
+
+One pass summary level tables
+=============================
+
+Instead of building the per-summary level tables from the geofile partition in a second
+build, the state geofiles can be read once, with each row routed to the table for its summary
+level and cut down to that table's columns as it is read. After Step 6:
+
+    $ bambry exec meta_add_sumlevel_sources
+    $ bambry exec ingest_sumlevels
+    $ bambry -m build
+
 """
 
 import ambry.bundle
 
+
+def cast_value(v, datatype):
+    """Cast a string value from an ingested file to a column datatype, as the built partition
+    has it. Int and float values that are not numbers are None, as with non_int_is_null. """
+
+    if datatype not in ('int', 'float'):
+        return v
+
+    try:
+        return (int if datatype == 'int' else float)(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def column_usage(headers, rows, block_size=10000, datatypes=None):
+    """Find the columns that have a value in at least one row of each summary level.
+
+    The rows are read in blocks, which are checked all at once, and each summary level
+    has a boolean mask of the columns that have been seen with values. As with `if v`, values
+    of None, '' and 0 count as empty.
+
+    With `datatypes`, a list of the datatype of each column, the rows are strings from an
+    ingested file, and the int and float columns are cast before they are checked, so '0'
+    and '00' are empty, as 0 is in the partition.
+
+    Returns a dict of the summary level to the set of names of the used columns.
+    """
+    import numpy as np
+    from itertools import islice
+
+    sl_i = headers.index('sumlevel')
+
+    numeric = [(i, t) for i, t in enumerate(datatypes or []) if t in ('int', 'float')]
+
+    masks = {}
+
+    rows = iter(rows)
+
+    while True:
+        block = list(islice(rows, block_size))
+
+        if not block:
+            break
+
+        a = np.array(block, dtype=object)
+
+        for i, t in numeric:
+            a[:, i] = [cast_value(v, t) for v in a[:, i]]
+
+        used = a.astype(bool)
+        sumlevels = a[:, sl_i]
+
+        for sl in set(sumlevels):
+            m = used[sumlevels == sl].any(axis=0)
+            masks[sl] = masks[sl] | m if sl in masks else m
+
+    usage = {}
+
+    for sl, m in masks.items():
+        # The ingested files have string summary levels, the partitions have ints.
+        sl = int(sl)
+        usage.setdefault(sl, set()).update(h for h, u in zip(headers, m) if u)
+
+    return usage
+
+
+def _datafile_column_usage(args):
+    """Pool worker, to scan the column usage of a row file. The columns of the file are
+    mapped to the source table columns by position, as meta_update_source_types does, and
+    their values are cast to the source datatypes. """
+    import os
+    from ambry_sources.mpf import MPRowsFile
+    from fs.opener import fsopendir
+
+    syspath, columns, block_size = args
+
+    f = MPRowsFile(fsopendir(os.path.dirname(syspath)), os.path.basename(syspath))
+
+    with f.reader as r:
+        # The source table positions start at 1, the file's at 0
+        names, datatypes = zip(*[columns[col.position + 1] for col in r.columns])
+
+        return column_usage(list(names), r.rows, block_size, list(datatypes))
+
+
+# Column types, in order of widening. A column has the widest type of any of its values.
+EMPTY, INT, FLOAT, STR = range(4)
+
+type_names = {EMPTY: 'unknown', INT: 'int', FLOAT: 'float', STR: 'str'}
+
+
+def value_type(v):
+    """Return the type code for a string value"""
+
+    v = v.strip() if v is not None else v
+
+    if not v:
+        return EMPTY
+
+    try:
+        int(v)
+        return INT
+    except ValueError:
+        pass
+
+    try:
+        float(v)
+        return FLOAT
+    except ValueError:
+        return STR
+
+
+def column_types(rows):
+    """Return a list of the type codes of the columns of a set of rows"""
+
+    types = []
+
+    for row in rows:
+        if len(row) > len(types):
+            types.extend([EMPTY] * (len(row) - len(types)))
+
+        for i, v in enumerate(row):
+            # Once a column is a string, it can't get any wider
+            if types[i] != STR:
+                t = value_type(v)
+                if t > types[i]:
+                    types[i] = t
+
+    return types
+
+
+def widen_types(a, b):
+    """Merge two lists of column type codes"""
+    from itertools import izip_longest
+
+    return [max(x, y) for x, y in izip_longest(a, b, fillvalue=EMPTY)]
+
+
+def _file_column_types(args):
+    """Pool worker, to find the column types of all of the rows of a zipped geofile"""
+    from fs.opener import fsopendir
+    from .zipindex import ZipIndex
+
+    cache_path, url, file_pattern = args
+
+    zip_index = ZipIndex(fsopendir(cache_path))
+
+    return column_types(zip_index.rows(url, file_pattern))
+
+
+class FixedWidthReader(object):
+    """Read fixed width records in blocks. Each block of lines is copied into a 2-D byte
+    array, and every kept column is sliced out of the whole block at once. Only string
+    columns are decoded, and int and float columns are cast a column at a time, with
+    values that are not numbers set to None, as non_int_is_null does. """
+
+    def __init__(self, columns, encoding='latin1', block_size=10000):
+        """
+        :param columns: a list of (name, start, width, datatype) tuples, for the columns to
+            keep. Start is the 1-based position of the first character of the column.
+        """
+
+        self.columns = [(name, int(start) - 1, int(width), datatype)
+                        for name, start, width, datatype in columns]
+        self.headers = [c[0] for c in self.columns]
+        self.encoding = encoding
+        self.block_size = block_size
+        self.record_width = max(start + width for name, start, width, datatype in self.columns)
+
+    def _cast(self, a, datatype):
+        """Convert a column of fixed width byte strings to a list of values"""
+        import numpy as np
+
+        a = np.char.strip(a)
+
+        if datatype in ('int', 'float'):
+            dtype = np.int64 if datatype == 'int' else np.float64
+            empty = a == b''
+
+            try:
+                values = np.where(empty, b'0', a).astype(dtype).astype(object)
+                values[empty] = None
+                return values.tolist()
+            except ValueError:
+                # Some values are not numbers; convert them one by one.
+                cast = int if datatype == 'int' else float
+
+                def f(v):
+                    try:
+                        return cast(v)
+                    except ValueError:
+                        return None
+
+                return [f(v) for v in a.tolist()]
+
+        return np.char.decode(a, self.encoding).tolist()
+
+    def iter_blocks(self, lines):
+        """Yield a list of column value lists for each block of lines"""
+        import numpy as np
+        from itertools import islice
+
+        w = self.record_width
+        lines = iter(lines)
+
+        while True:
+            block = [l.rstrip(b'\r\n')[:w].ljust(w) for l in islice(lines, self.block_size)]
+
+            if not block:
+                return
+
+            m = np.frombuffer(b''.join(block), dtype=np.uint8).reshape(len(block), w)
+
+            yield [self._cast(np.ascontiguousarray(m[:, start:start+width]).view('S{}'.format(width)).ravel(),
+                              datatype)
+                   for name, start, width, datatype in self.columns]
+
+    def __call__(self, lines):
+        """Yield rows, as tuples, from an iterable of lines"""
+        from itertools import izip
+
+        for columns in self.iter_blocks(lines):
+            for row in izip(*columns):
+                yield row
+
+
+class GeofileRowGenerator(object):
+    """Generate geofile rows from the fixed width geofile in the source's archive, using
+    the start and width of the columns of the geofile source table"""
+
+    def __init__(self, bundle, source):
+        self.bundle = bundle
+        self.source = source
+
+    @property
+    def reader(self):
+        columns = [(c.source_header, c.start, c.width, c.datatype)
+                   for c in sorted(self.bundle.source_table('geofile').columns, key=lambda c: c.position)
+                   if c.start and c.width]
+
+        return FixedWidthReader(columns)
+
+    def __iter__(self):
+        from .zipindex import ZipIndex
+
+        reader = self.reader
+
+        yield reader.headers
+
+        zip_index = ZipIndex(self.bundle.library.download_cache)
+
+        # The fixed width files have the same names as the CSV files, with a .txt extension
+        f = zip_index.open(self.source.url, 'g{}.*\.txt'.format(self.bundle.year))
+
+        try:
+            for row in reader(f):
+                yield row
+        finally:
+            f.close()
+
+
+class SumlevelRouter(object):
+    """Read fixed width geofiles once, routing each row to the per-summary level table for its
+    summary level and projecting it to that table's columns. Only the columns that are used
+    by at least one of the tables are read from the files. """
+
+    def __init__(self, bundle, tables=None):
+        import re
+
+        self.bundle = bundle
+
+        if tables is None:
+            tables = [t for t in bundle.tables if re.match(r'geofile\d+$', t.name)]
+
+        self.tables = {int(t.name[len('geofile'):]): t for t in tables}
+
+        used = set(['sumlevel'])
+        for t in self.tables.values():
+            used |= set(c.name for c in t.columns)
+
+        st_columns = sorted(bundle.source_table('geofile').columns, key=lambda c: c.position)
+
+        self.reader = FixedWidthReader([(c.source_header, c.start, c.width, c.datatype)
+                                        for c in st_columns
+                                        if c.start and c.width and c.source_header in used])
+
+        self.sumlevel_index = self.reader.headers.index('sumlevel')
+
+        # Positions of each table's columns in the rows from the reader
+        self.projections = {}
+        self.headers = {}
+
+        for sl, t in self.tables.items():
+            names = [c.name for c in t.columns if c.name in self.reader.headers]
+            self.headers[sl] = names
+            self.projections[sl] = [self.reader.headers.index(n) for n in names]
+
+    def route(self, lines):
+        """Yield (sumlevel, row) for every row of a geofile that has a table"""
+        import numpy as np
+
+        for columns in self.reader.iter_blocks(lines):
+            a = np.empty((len(columns), len(columns[0])), dtype=object)
+            for i, c in enumerate(columns):
+                a[i, :] = c
+
+            sumlevels = a[self.sumlevel_index]
+
+            for v in set(sumlevels):
+                try:
+                    sl = int(v)
+                except (TypeError, ValueError):
+                    continue
+
+                if sl not in self.projections:
+                    continue
+
+                for row in a[self.projections[sl]][:, sumlevels == v].T.tolist():
+                    yield sl, tuple(row)
+
+    def __call__(self, urls):
+        """Yield (sumlevel, row) for all of the rows of the geofiles in the archives at urls"""
+        from .zipindex import ZipIndex
+
+        zip_index = ZipIndex(self.bundle.library.download_cache)
+
+        for url in urls:
+            f = zip_index.open(url, 'g{}.*\.txt'.format(self.bundle.year))
+
+            try:
+                for sl, row in self.route(f):
+                    yield sl, row
+            finally:
+                f.close()
+
+
+class GeofileSumlevelGenerator(object):
+    """Generate the rows for one per-summary level table. This reads all of the geofiles
+    for just the one table, so it is only a fallback for when GeofileBundle.ingest_sumlevels
+    hasn't already ingested the source. """
+
+    def __init__(self, bundle, source):
+        self.bundle = bundle
+        self.source = source
+
+    def __iter__(self):
+
+        router = SumlevelRouter(self.bundle, [self.source.dest_table])
+
+        sl = router.tables.keys()[0]
+
+        yield router.headers[sl]
+
+        for _, row in router(self.bundle.geofile_urls(self.source.time)):
+            yield row
+
+
 class GeofileBundle(ambry.bundle.Bundle):
 
     year = None
 
+    # Number of concurrent downloads when pre-downloading the geofile archives
+    download_processes = 4
+
     def init(self):
         self._sl_map = None
 
+    def _pre_download(self, urls):
+        """Download geofile archives before they are read from the download cache, by
+        GeofileRowGenerator, SumlevelRouter or the type sampling pool"""
+        from .download import download_all
+
+        download_all(urls, self.library.download_cache, processes=self.download_processes,
+                     log=self.log)
+
+    def ingest(self, sources=None, tables=None, stage=None, force=False, update_tables=True):
+        """Download the geofile archives that the selected generator sources read all at once,
+        before ingesting"""
+
+        def names(v):
+            if v is None:
+                return None
+            if isinstance(v, basestring) or not hasattr(v, '__iter__'):
+                v = [v]
+            return set(getattr(e, 'name', e) for e in v)
+
+        source_names, table_names = names(sources), names(tables)
+
+        urls = set()
+        time_urls = {}  # geofile_urls() for each time, shared by the summary level sources
+
+        for s in self.sources:
+            if s.reftype != 'generator':
+                continue
+
+            if source_names is not None and s.name not in source_names:
+                continue
+
+            if table_names is not None and s.dest_table_name not in table_names:
+                continue
+
+            if stage is not None and s.stage != int(stage):
+                continue
+
+            if s.ref == 'GeofileRowGenerator' and s.url:
+                urls.add(s.url)
+            elif s.ref == 'GeofileSumlevelGenerator':
+                if s.time not in time_urls:
+                    time_urls[s.time] = self.geofile_urls(s.time)
+                urls.update(time_urls[s.time])
+
+        if urls:
+            self._pre_download(sorted(urls))
+
+        return super(GeofileBundle, self).ingest(sources, tables, stage, force, update_tables)
+
     @staticmethod
     def non_int_is_null(v):
 
@@ -241,12 +681,98 @@ class GeofileBundle(ambry.bundle.Bundle):
 
         self.commit()
 
+    def meta_fixed_width_sources(self):
+        """Change the geofile sources to read the fixed width files with GeofileRowGenerator"""
+
+        for s in self.sources:
+            if s.dest_table_name == 'geofile' and s.reftype != 'generator':
+                s.reftype = 'generator'
+                s.ref = 'GeofileRowGenerator'
+                self.session.merge(s)
+
+        self.commit()
+
+        self.build_source_files.sources.objects_to_record()
+
+        self.commit()
+
+    def geofile_urls(self, time=None):
+        """Return the URLs of the geofile archives for a release, by default the 5 year"""
+
+        time = time or '{}5'.format(self.year)
+
+        return sorted(set(s.url for s in self.sources
+                          if s.dest_table_name == 'geofile' and s.time == time and s.url))
+
+    def meta_add_sumlevel_sources(self):
+        """Add a source for each per-summary level table, for ingest_sumlevels to write"""
+        import re
+        from ambry.orm.exc import NotFoundError
+
+        for t in self.tables:
+            if not re.match(r'geofile\d+$', t.name):
+                continue
+
+            d = {
+                'name': t.name,
+                'dest_table_name': t.name,
+                'reftype': 'generator',
+                'ref': 'GeofileSumlevelGenerator',
+                'time': '{}5'.format(self.year),
+                'stage': 2
+            }
+
+            try:
+                s = self._dataset.source_file(d['name'])
+                s.update(**d)
+            except NotFoundError:
+                s = self.dataset.new_source(**d)
+
+            self.session.merge(s)
+
+        self.commit()
+
+        self.build_source_files.sources.objects_to_record()
+
+        self.commit()
+
+    def ingest_sumlevels(self, force=False):
+        """Read each of the geofiles once, writing the rows for every summary level into the
+        datafile of the source for its per-summary level table"""
+        from .util import needs_ingest, write_sources
+
+        router = SumlevelRouter(self)
+
+        sources = {}
+        for sl, t in router.tables.items():
+            s = self.source(t.name)
+            if needs_ingest(s, force):
+                sources[sl] = s
+
+        if not sources:
+            self.log("Summary level sources already ingested")
+            return
+
+        self.log("Ingesting {} summary level sources".format(len(sources)))
+
+        urls = self.geofile_urls()
+
+        self._pre_download(urls)
+
+        write_sources(self, sources, router.headers, router(urls))
+
     ##
     ## Meta Step 4: Update the datatype based on a single ingestion
     ##
-    def meta_update_source_types(self):
+    def meta_update_source_types(self, processes=None):
+        """Set the column datatypes from an ingestion of the California file or, if a number of
+        processes is given, from all of the rows of the geofiles for every state of the 5 year
+        release, read in parallel"""
         from ambry_sources.intuit import TypeIntuiter
 
+        if processes:
+            return self._update_source_types_parallel(int(processes))
+
         source_name = 'CaliforniaS_{}5'.format(self.year)
 
         s = self.source(source_name)
@@ -283,31 +809,101 @@ class GeofileBundle(ambry.bundle.Bundle):
         self.commit()
 
 
+    def _update_source_types_parallel(self, processes):
+        from multiprocessing import Pool
+
+        time = '{}5'.format(self.year)
+        cache = self.library.download_cache
+
+        args = [(cache.getsyspath('/'), s.url, s.file) for s in self.sources
+                if s.dest_table_name == 'geofile' and s.url and s.time == time]
+
+        self._pre_download(sorted(set(a[1] for a in args)))
+
+        self.log("Finding column types in {} geofiles with {} processes".format(len(args), processes))
+
+        types = []
+
+        pool = Pool(processes)
+
+        try:
+            for t in pool.imap_unordered(_file_column_types, args):
+                types = widen_types(types, t)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        st = self.source_table('geofile')
+        dt = self.table('geofile')
+
+        for c in st.columns:
+            t = types[c.position - 1] if c.position - 1 < len(types) else EMPTY
+
+            c.datatype = type_names[t] if t != EMPTY else 'str'
+
+            dc = dt.column(c.name)
+            dc.datatype = c.datatype
+
+        self.commit()
+
+        self.build_source_files.sourceschema.objects_to_record()
+        self.build_source_files.schema.objects_to_record()
+
+        self.commit()
+
     ##
     ## Meta Step 6, After Build: Create per-summary level tables
     ##
-    def meta_build_reduced_schemas(self):
+    def meta_build_reduced_schemas(self, processes=None):
         """
         After running once, it is clear that not all columns are used in all
         summary levels. This routine builds new tables for all of the summary
         levels that have only the columns that are used.
 
+        With `processes`, the ingested state files for the 5 year release are scanned
+        in a process pool, instead of the built partition.
 
         """
         from collections import defaultdict
-        from itertools import islice, izip
 
         table_titles = { int(r['sumlevel']): r['description'] if r['description'] else r['sumlevel']
                          for r in self.dep('sumlevels')}
 
-        p = self.partition(table='geofile', time='{}5'.format(self.year))
-
-
         # Create a dict of sets, where each set holds the non-empty columns for rows of
         # a summary level
         gf = defaultdict(set)
-        for r in p:
-            gf[r.sumlevel] |= set(k for k,v in r.items() if v)
+
+        if processes and int(processes) > 1:
+            from multiprocessing import Pool
+
+            time = '{}5'.format(self.year)
+
+            # The source table name and datatype of each column, by position
+            columns = {c.position: (c.name, c.datatype) for c in self.source_table('geofile').columns}
+
+            args = [(s.datafile.syspath, columns, 10000) for s in self.sources
+                    if s.dest_table_name == 'geofile' and s.time == time and s.datafile.exists]
+
+            self.log("Scanning {} state files with {} processes".format(len(args), processes))
+
+            pool = Pool(int(processes))
+
+            try:
+                for usage in pool.imap_unordered(_datafile_column_usage, args):
+                    for sumlevel, fields in usage.items():
+                        gf[sumlevel] |= fields
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        else:
+            p = self.partition(table='geofile', time='{}5'.format(self.year))
+
+            with p.reader as r:
+                for sumlevel, fields in column_usage(r.headers, r.rows).items():
+                    gf[sumlevel] |= fields
 
         for sumlevel, fields in gf.items():
 
@@ -0,0 +1,229 @@
+"""
+A compact index for joining table rows to the geofile.
+
+The index holds one sorted array of logical record numbers for each state, stored as
+segments of a single array, with parallel arrays of geoids, gvids and summary levels. Lookups use
+a direct offset when a state's record numbers are contiguous, which they nearly always
+are, and a binary search otherwise.
+
+Indexes are saved as a directory of .npy files, which are memory mapped read-only when
+they are loaded, so all of the processes of a build share the same pages.
+
+"""
+
+import numpy as np
+
+ARRAYS = ('logrecnos', 'geoids', 'gvids', 'sumlevels')
+
+
+def acs_gvid(geoid):
+    """Convert an ACS geoid string to a gvid string"""
+    from geoid.acs import AcsGeoid
+    from geoid.civick import GVid
+
+    return str(AcsGeoid.parse(geoid).convert(GVid))
+
+
+def geofile_rows(rows, log=None):
+    """Yield the (stusab, logrecno, geoid, gvid, sumlevel) tuples for GeofileIndex.from_rows()
+    from the rows of a geofile partition. A geoid that can't be parsed or converted gets an
+    empty gvid, rather than failing the whole index, and the number of them is logged. """
+
+    errors = 0
+
+    for row in rows:
+        try:
+            gvid = acs_gvid(row.geoid)
+        except ImportError:
+            raise
+        except Exception:
+            gvid = ''
+            errors += 1
+
+        yield row.stusab, row.logrecno, row.geoid, gvid, row.sumlevel
+
+    if errors and log:
+        log("{} geofile rows had a geoid that could not be converted to a gvid".format(errors))
+
+
+class GeofileIndex(object):
+    """Map (stusab, logrecno) to a geoid, gvid and summary level"""
+
+    def __init__(self, states, logrecnos, geoids, gvids, sumlevels):
+        """
+        :param states: dict of stusab to (start, end, first_logrecno, dense) for each state's
+            segment of the arrays. dense is True if the segment's logrecnos are contiguous.
+        :param logrecnos: int array of logrecnos, sorted within each state segment
+        :param geoids: fixed width string array of geoids
+        :param gvids: fixed width string array of gvids
+        :param sumlevels: int array of summary levels
+        """
+        self.states = states
+        self.logrecnos = logrecnos
+        self.geoids = geoids
+        self.gvids = gvids
+        self.sumlevels = sumlevels
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build an index from an iterable of (stusab, logrecno, geoid, gvid, sumlevel) tuples"""
+
+        stusabs, logrecnos, geoids, gvids, sumlevels = [], [], [], [], []
+
+        for stusab, logrecno, geoid, gvid, sumlevel in rows:
+            stusabs.append(stusab.upper())
+            logrecnos.append(int(logrecno))
+            geoids.append(str(geoid))
+            gvids.append(str(gvid))
+            sumlevels.append(int(sumlevel) if sumlevel is not None else -1)
+
+        stusabs = np.array(stusabs, dtype=str)
+        logrecnos = np.array(logrecnos, dtype=np.int32)
+
+        order = np.lexsort((logrecnos, stusabs))
+
+        stusabs = stusabs[order]
+        logrecnos = logrecnos[order]
+        geoids = np.array(geoids, dtype=str)[order]
+        gvids = np.array(gvids, dtype=str)[order]
+        sumlevels = np.array(sumlevels, dtype=np.int16)[order]
+
+        states = {}
+
+        if len(stusabs):
+            # Boundaries of the runs of each state
+            bounds = np.concatenate(([0], np.nonzero(stusabs[1:] != stusabs[:-1])[0] + 1, [len(stusabs)]))
+
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                start, end = int(start), int(end)
+                first = int(logrecnos[start])
+                dense = int(logrecnos[end-1]) - first == end - start - 1
+                states[str(stusabs[start])] = (start, end, first, dense)
+
+        return cls(states, logrecnos, geoids, gvids, sumlevels)
+
+    def __len__(self):
+        return len(self.logrecnos)
+
+    def save(self, path):
+        """Save the index to a directory, which must not already exist. The index is written
+        to a temporary directory first, so a partly written index is never loaded. """
+        import os
+        import json
+        import shutil
+        import tempfile
+
+        parent = os.path.dirname(os.path.abspath(path))
+
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        tmp = tempfile.mkdtemp(dir=parent)
+
+        try:
+            for name in ARRAYS:
+                np.save(os.path.join(tmp, name + '.npy'), getattr(self, name))
+
+            with open(os.path.join(tmp, 'states.json'), 'w') as f:
+                json.dump(self.states, f)
+
+            os.rename(tmp, path)
+
+        except OSError:
+            # Another process saved the index first
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load an index that was saved to a directory, memory mapping the arrays"""
+        import os
+        import json
+
+        with open(os.path.join(path, 'states.json')) as f:
+            states = {str(k): tuple(v) for k, v in json.load(f).items()}
+
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS]
+
+        return cls(states, *arrays)
+
+    @classmethod
+    def cached(cls, cache, key, rows_f):
+        """Load the index saved in a cache under a key, such as the versioned id of the geofile
+        partition, or build it from the rows returned by rows_f() and save it.
+
+        :param cache: A filesystem, such as library.download_cache
+        :param key: A string that identifies the source of the index
+        :param rows_f: A function that returns an iterable of rows for from_rows()
+        """
+        import os
+        from .util import versioned_cache_path
+
+        path = cache.getsyspath(versioned_cache_path('geoindex', key))
+
+        if not os.path.exists(path):
+            cls.from_rows(rows_f()).save(path)
+
+        return cls.load(path)
+
+    def offset(self, stusab, logrecno):
+        """Return the position of a record in the arrays. Raises KeyError if it isn't there"""
+
+        start, end, first, dense = self.states[stusab.upper()]
+
+        if dense:
+            i = start + logrecno - first
+        else:
+            i = start + int(np.searchsorted(self.logrecnos[start:end], logrecno))
+
+        if not start <= i < end or self.logrecnos[i] != logrecno:
+            raise KeyError((stusab, logrecno))
+
+        return i
+
+    def lookup(self, stusab, logrecno):
+        """Return (geoid, gvid, sumlevel) for a record"""
+
+        i = self.offset(stusab, int(logrecno))
+
+        return str(self.geoids[i]), str(self.gvids[i]), int(self.sumlevels[i])
+
+    def offsets(self, stusabs, logrecnos):
+        """Return an array of the positions of a block of records. Raises KeyError if any of
+        them aren't there"""
+
+        stusabs = np.array([s.upper() for s in stusabs], dtype=str)
+        logrecnos = np.asarray(logrecnos).astype(np.int64)
+
+        offsets = np.empty(len(logrecnos), dtype=np.int64)
+
+        for stusab in np.unique(stusabs):
+            start, end, first, dense = self.states[str(stusab)]
+
+            sel = stusabs == stusab
+            lr = logrecnos[sel]
+
+            if dense:
+                i = lr - first
+            else:
+                i = np.searchsorted(self.logrecnos[start:end], lr)
+
+            i = np.clip(i, 0, end - start - 1) + start
+
+            bad = self.logrecnos[i] != lr
+            if bad.any():
+                raise KeyError((str(stusab), int(lr[bad][0])))
+
+            offsets[sel] = i
+
+        return offsets
+
+    def lookup_block(self, stusabs, logrecnos):
+        """Return arrays of the geoids, gvids and summary levels for a block of records"""
+
+        i = self.offsets(stusabs, logrecnos)
+
+        return self.geoids[i], self.gvids[i], self.sumlevels[i]
@@ -1,5 +1,7 @@
 # Mixins for creating the destination schemna
 
+from ambry.util import memoize
+
 
 class MakeTablesMixin(object):
     
@@ -8,6 +10,11 @@ class MakeTablesMixin(object):
     ##
         
     def create_table_schema(self):
+        """Create all of the tables and their sources from the table catalog. The tables and
+        columns are created with autoflush off, so the session doesn't flush the pending
+        objects every time the ORM looks something up. The session is flushed once for each
+        table, before its source is created, so the sequence ids and vids that the ORM assigns
+        from the database always see the tables and sources that came before. """
 
         if self.tables:
             self.log("Deleteting old tables and partitions")
@@ -20,17 +27,24 @@ class MakeTablesMixin(object):
         self.log("Creating {} tables".format(len(tables)))
         
         lr = self.init_log_rate(100)
-        
-        for i, table_id in enumerate(sorted(tables.keys())):
 
-            d = tables[table_id]
-            
-            lr(table_id)
-            print i, table_id
-            
-            t = self.make_table( i+1, **d )
-            
-            self.make_source(t)
+        # Look up all of the existing sources at once, rather than trying to
+        # load the source for each table and catching the NotFoundError
+        sources = {s.name: s for s in self.dataset.sources}
+
+        with self.session.no_autoflush:
+            for i, table_id in enumerate(sorted(tables.keys())):
+
+                d = tables[table_id]
+
+                lr(table_id)
+
+                t = self.make_table( i+1, **d )
+
+                self.session.flush()
+
+                if t.name not in sources:
+                    sources[t.name] = self._new_table_source(t)
             
         self.commit()
 
@@ -39,6 +53,8 @@ class MakeTablesMixin(object):
 
         self.commit()
 
+        self.build_dimension_catalog()
+
 
     def make_table(self,  sequence_id, name, universe, description, columns, data):
         """Meta-phase routine to create a single table, called from 
@@ -61,12 +77,13 @@ class MakeTablesMixin(object):
               description='Geoid from geofile', transform='^join_geoid')
            
         t.add_column(name='gvid', datatype='census.GVid', 
-              description='GVid from geoid', transform='||row.geoid.gvid')
+              description='GVid from geoid', transform='^join_gvid')
               
         t.add_column(name='sumlevel', datatype='int', 
-              description='Summary Level', transform='||row.geoid.sl')
+              description='Summary Level', transform='^join_sumlevel')
             
-        t.add_column(name='jam_flags', datatype='str', transform='^jam_values',
+        # The generators decode the jam values, and write their codes to jam_flags
+        t.add_column(name='jam_flags', datatype='str',
               description='Flags for converted Jam values')
            
            
@@ -80,7 +97,6 @@ class MakeTablesMixin(object):
                 
             t.add_column( name=col['name'], 
                           description=col['description'],
-                          transform='^jam_float', 
                           datatype='float',
                           data=col['data'])
             
@@ -90,122 +106,88 @@ class MakeTablesMixin(object):
         return t
 
     def make_source(self, table):
+        """Return the source for a table, creating it if it doesn't exist"""
         from ambry.orm.exc import NotFoundError
 
         try:
             ds = self._dataset.source_file(table.name)
         except NotFoundError:
-            ds = self._dataset.new_source(table.name,
-                                          dest_table_name=table.name,
-                                          reftype='generator',
-                                          ref='TableRowGenerator')
+            ds = self._new_table_source(table)
 
         except:  # Odd error with 'none' in keys for d
             raise
 
-    def tables_list(self, add_columns = True):
-        """
-        :param add_columns:
-        :return:
-        """
-        from collections import defaultdict
-        from ambry.orm.source import DataSource
-        from ambry.util import init_log_rate
-        
-        def prt(v): print v
-        
-        lr = init_log_rate(prt)
+        return ds
 
-        tables = defaultdict(lambda: dict(table=None, universe = None, columns = []))
+    def _new_table_source(self, table):
+        return self._dataset.new_source(table.name,
+                                        dest_table_name=table.name,
+                                        reftype='generator',
+                                        ref='TableRowGenerator')
 
-        year = self.year
-        release = self.release
+    @property
+    @memoize
+    def table_catalog(self):
+        """The TableCatalog for the bundle's year and release. It is built from the table_sequence
+        dependency once, and saved in the library download cache. Limited runs build a partial
+        catalog, which is not saved. """
+        from .catalog import TableCatalog
 
-        table_id = None
-        seen = set()
-        ignore = set()
-        
-        #name, universe, description, columns
-        
-        i = 0
+        p = self.dep('table_sequence')
 
-        with self.dep('table_sequence').datafile.reader as r:
-            for row in r:
+        def rows():
+            with p.datafile.reader as r:
+                for row in r:
+                    yield row
 
-                if int(row['year']) != int(year) or int(row['release']) != int(release):
-                    print "Ignore {} {} != {} {} ".format(row['year'], row['release'], year, release)
-                    continue
+        if self.limited_run:
+            return TableCatalog.from_rows(rows(), self.year, self.release, limit=1000, log=self.log)
 
-                if row['table_id'] in ignore:
-                    continue
+        return TableCatalog.cached(self.library.download_cache, p.vid, self.year, self.release, rows,
+                                   log=self.log)
 
-                if int(row['sequence_number'] ) > 117:
-                    # Not sure where the higher sequence numbers are, but they aren't in this distribution. 
-                    continue
-                    
-                i += 1
+    @property
+    @memoize
+    def dimension_catalog(self):
+        """The DimensionCatalog of the columns of all of the bundle's tables. It is saved in the
+        library download cache, keyed by the dataset vid. """
+        from .dimensions import DimensionCatalog
 
-                table_name = row['table_id']
+        return DimensionCatalog.cached(self.library.download_cache, self.dataset.vid,
+                                       lambda: self.tables)
 
-                if row['start']:
-        
-                    # Breaking here ensures we've loaded all of the columns for
-                    # the previous tables. 
-                    if self.limited_run and i > 1000:
-                        break
-        
-                    if table_name in seen:
-                        ignore.add(table_name)
-                        continue
-                    else:
-                        seen.add(table_name)
-        
-                    start = int(float(row['start']))
-                    length = int(row['table_cells'])
-                    
-
-                    tables[table_name] = dict(
-                        name = row['table_id'],
-                        universe=None,
-                        description=row['title'].title(),
-                        columns=[],
-                        data = dict(
-                            sequence = int(row['sequence_number']),
-                            start=start, 
-                            length=length, 
-                            
-                        )
-                    )
-                    #self.log("Added table: {}".format(row['table_id']))
+    def build_dimension_catalog(self):
+        """Classify the columns of all of the bundle's tables, and save the catalog, replacing
+        any catalog saved for an earlier schema"""
+        from .dimensions import DimensionCatalog
+        from .util import save_json
+
+        catalog = DimensionCatalog.from_tables(self.tables)
+
+        save_json(self.library.download_cache, DimensionCatalog.path(self.dataset.vid),
+                  catalog.to_data())
+
+        self.log("Saved dimension catalog for {} columns of {} tables"
+                 .format(len(catalog), len(catalog.tables)))
+
+        return catalog
+
+    def tables_list(self, add_columns = True):
+        """Return a dict of the tables for the bundle's year and release, from the table catalog
+
+        :param add_columns: If False, the table dicts have empty column lists
+        :return: A dict of table id to the keyword arguments for make_table()
+        """
+        from collections import OrderedDict
+
+        tables = OrderedDict()
+
+        for table_id, d in self.table_catalog.tables.items():
+            d = dict(d)
+
+            if not add_columns:
+                d['columns'] = []
+
+            tables[table_id] = d
 
-        
-                elif 'Universe' in row['title']:
-                    tables[table_name]['universe'] = row['title'].replace('Universe: ','').strip()
-
-                elif add_columns and row['is_column'] == 'Y':
-                    
-                    col_name = table_name+"{:03d}".format(int(row['line']))
-  
-                    col_names = [ c['name'] for c in tables[table_name]['columns'] ]
-                    if col_name  in col_names:
-                        raise Exception("Already have {} in {}".format(col_name, 
-                                        col_names))
-  
-                    tables[table_name]['columns'].append(dict(
-                        name=col_name,
-                        description=row['title'], 
-                        datatype = 'float',
-                        data=dict(start=row['segment_column']))
-                        )
-                        
-                    # Add the margin of error column
-                    tables[table_name]['columns'].append(dict(
-                        name=col_name+'_m90',
-                        description="Margin of error for: "+col_name, 
-                        datatype = 'float',
-                        data=dict(start=row['segment_column']))
-                        )
-                    
-                    
         return tables
- 
\ No newline at end of file
@@ -2,6 +2,76 @@
 
 from ambry.util import memoize
 
+def rle(s):
+    "Run-length encoded"
+    from itertools import chain, groupby
+
+    return ''.join(str(e) for e in chain(*[(len(list(g)), k)
+                                    for k,g in groupby(s)]))
+
+def decode_jams(a, jam_map):
+    """Convert a row, or a 2-D block of rows, of data values to floats, and collect the jam
+    codes for the values that are not numbers, with the same results as calling jam_float
+    on each value. Returns a float array, with NaN for jam values, a boolean array that is
+    True for the jam values, or None if there are none, and a list with a string of jam
+    codes, or None, for each row. """
+    import numpy as np
+    from itertools import groupby
+    from ambry.valuetype.types import nullify
+
+    a = np.asarray(a, dtype=object)
+    a = a.reshape(1, -1) if a.ndim == 1 else a
+
+    # Numpy casts None to NaN, rather than failing, so it has to be checked for first
+    mask = np.equal(a, None)
+
+    if not mask.any():
+        try:
+            # Nearly all blocks have no jam values at all
+            return a.astype(np.float64), None, [None] * a.shape[0]
+        except (ValueError, TypeError):
+            pass
+
+    for k in jam_map:
+        if k is not None:
+            mask |= np.equal(a, k)
+
+    b = a.copy()
+    b[mask] = 'nan'
+
+    try:
+        values = b.astype(np.float64)
+    except (ValueError, TypeError):
+        # Some other kind of jam value, possibly with whitespace, so find them one by one.
+        def is_jam(v):
+            try:
+                float(nullify(v))
+                return False
+            except (ValueError, TypeError):
+                return True
+
+        with np.errstate(invalid='ignore'):
+            mask = np.frompyfunc(is_jam, 1, 1)(a).astype(bool)
+        b = a.copy()
+        b[mask] = 'nan'
+        values = b.astype(np.float64)
+
+    # There are only a few distinct jam values, so look up their codes once. Raises
+    # KeyError for unknown jam values, as jam_float does.
+    codes = {v: jam_map[nullify(v)] for v in set(a[mask])}
+
+    jams = [None] * a.shape[0]
+    rows, cols = np.nonzero(mask)
+    jam_values = a[rows, cols]
+
+    i = 0
+    for row, g in groupby(rows):
+        n = len(list(g))
+        jams[row] = ''.join(codes[v] for v in jam_values[i:i+n])
+        i += n
+
+    return values, mask, jams
+
 class JamValueMixin(object):
     
      jam_map = {
@@ -33,16 +103,9 @@ class JamValueMixin(object):
      
      def jam_values(self, errors, row):
          """Write the collected jam codes to the jam_value field."""
-         from itertools import chain, groupby
-        
+
          jams =  errors.get('jams')
-        
-         def rle(s):
-             "Run-length encoded"
-             return ''.join(str(e) for e in chain(*[(len(list(g)), k) 
-                                             for k,g in groupby(s)]))
-        
-       
+
          return rle(jams) if jams else None
 
     
@@ -51,14 +114,47 @@ class JoinGeofileMixin(object):
      @property
      @memoize
      def geofile(self):
+         """A GeofileIndex of the geoid, gvid and summary level for each state and logrecno.
+         The index is saved in the download cache the first time it is built for a version
+         of the geofile partition, and is memory mapped after that."""
+         from .geoindex import GeofileIndex, geofile_rows
+
+         p = self.dep('geofile')
+
+         def rows():
+             with p.reader as r:
+                 for row in geofile_rows(r, self.log):
+                     yield row
 
-         with self.dep('geofile').reader as r:
-             return { (row.stusab, row.logrecno): (row.geoid, row.sumlevel)  
-                      for row in r }
+         return GeofileIndex.cached(self.library.download_cache, p.vid, rows)
+
+     def _geofile_offset(self, row):
+         """Return the position of the row's record in the geofile index. The last lookup is
+         kept, because the geoid, gvid and sumlevel transforms all use it for the same row"""
+
+         key = (row.stusab, row.logrecno)
+         last = getattr(self, '_last_geofile_offset', None)
+
+         if last is None or last[0] != key:
+             last = (key, self.geofile.offset(row.stusab, int(row.logrecno)))
+             self._last_geofile_offset = last
+
+         return last[1]
         
      def join_geoid(self, row):
          """Add a geoid to the row, from the geofile partition, linked via the
          state abbreviation and logrecno"""
-         return self.geofile[(row.stusab.upper(), int(row.logrecno))][0]
- 
- 
\ No newline at end of file
+         return str(self.geofile.geoids[self._geofile_offset(row)])
+
+     def join_gvid(self, row):
+         """Add the gvid for the row's geoid, from the geofile index"""
+         return str(self.geofile.gvids[self._geofile_offset(row)])
+
+     def join_sumlevel(self, row):
+         """Add the summary level for the row's geoid, from the geofile index"""
+         return int(self.geofile.sumlevels[self._geofile_offset(row)])
+
+     def join_geoids(self, stusabs, logrecnos):
+         """Return arrays of the geoids, gvids and summary levels for a block of rows, given
+         sequences of the state abbreviations and logrecnos"""
+         return self.geofile.lookup_block(stusabs, logrecnos)
@@ -1,5 +1,17 @@
 # Utilities
 
+from contextlib import contextmanager
+
+# Versions of the formats of the files that are saved under _censuslib/ in the download
+# cache, by kind. Change the version for a kind when its format changes, so files saved in
+# the old format are not used.
+FORMAT_VERSIONS = {
+    'catalog': 1,
+    'dimensions': 1,
+    'geoindex': 2,
+}
+
+
 def year_release(b):
     import isodate
 
@@ -8,4 +20,139 @@ def year_release(b):
     release = int(isodate.parse_duration(r).years)
     year = int(isodate.parse_date(y).year)
 
-    return year, release
\ No newline at end of file
+    return year, release
+
+@contextmanager
+def file_lock(fs, path):
+    """Hold an exclusive lock, shared between processes, on a lock file beside a file
+    in a filesystem"""
+    import fcntl
+    from os.path import dirname
+
+    fs.makedir(dirname(path), recursive=True, allow_recreate=True)
+
+    with open(fs.getsyspath(path + '.lock'), 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def versioned_cache_path(kind, key, ext=''):
+    """Return the path in the download cache for a saved file of a kind, such as 'catalog',
+    with the kind's format version in the name"""
+
+    return '_censuslib/{}/{}-{}{}'.format(kind, key, FORMAT_VERSIONS[kind], ext)
+
+
+def load_json(fs, path, default=None, **kwargs):
+    """Return the decoded contents of a JSON file in a filesystem, or `default` if there is
+    no file. Keyword arguments are passed to json.load(). """
+    import json
+
+    if not fs.exists(path):
+        return default
+
+    with fs.open(path, 'rb') as f:
+        return json.load(f, **kwargs)
+
+
+def save_json(fs, path, data, **kwargs):
+    """Write a JSON file into a filesystem atomically. The data is written to a temp file
+    that is private to the process and thread, then renamed over the old file, so readers
+    see either the old file or the new one, never a partial file. Keyword arguments are
+    passed to json.dump(). """
+    import json
+    import os
+    import threading
+    from os.path import dirname
+
+    fs.makedir(dirname(path), recursive=True, allow_recreate=True)
+
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+
+    try:
+        with fs.open(tmp_path, 'wb') as f:
+            json.dump(data, f, **kwargs)
+
+        os.rename(fs.getsyspath(tmp_path), fs.getsyspath(path))
+    finally:
+        if fs.exists(tmp_path):
+            fs.remove(tmp_path)
+
+
+def update_json(fs, path, f, default=None, **kwargs):
+    """Update a JSON file that several processes may be writing. Under a lock, the file
+    is read again, passed to `f`, and the return value of `f` is saved, with the keyword
+    arguments for json.dump(). Returns the saved data. """
+
+    with file_lock(fs, path):
+        data = f(load_json(fs, path, default))
+        save_json(fs, path, data, **kwargs)
+
+    return data
+
+
+def cached_json(fs, path, build_f, to_data, from_data, **kwargs):
+    """Return an object that is saved in a filesystem as JSON, or build it and save it.
+
+    :param build_f: A function that builds the object, if it hasn't been saved
+    :param to_data: A function that converts the object to data for json.dump()
+    :param from_data: A function that converts data from json.load() back to the object
+    :param kwargs: Keyword arguments for json.load(), such as object_pairs_hook
+    """
+
+    data = load_json(fs, path, **kwargs)
+
+    if data is not None:
+        return from_data(data)
+
+    obj = build_f()
+
+    save_json(fs, path, to_data(obj))
+
+    return obj
+
+
+def needs_ingest(s, force=False):
+    """Return True if a source has not been completely ingested. A source that has a datafile
+    but is still marked as ingesting was interrupted, so its datafile is incomplete."""
+    return force or not s.datafile.exists or s.state == s.STATES.INGESTING
+
+
+def write_sources(b, sources, headers, rows):
+    """Write rows into the datafiles of several sources at once, as if each had been ingested.
+
+    :param b: The bundle
+    :param sources: dict of a key to the source to write
+    :param headers: dict of the same keys to the header list for the source
+    :param rows: iterable of (key, row) tuples. Rows for keys that aren't in sources are dropped.
+    """
+
+    writers = {}
+
+    for s in sources.values():
+        s.state = s.STATES.INGESTING
+
+    b.commit()
+
+    try:
+        for key, s in sources.items():
+            w = s.datafile.writer
+            w.headers = headers[key]
+            writers[key] = w
+
+        for key, row in rows:
+            w = writers.get(key)
+            if w is not None:
+                w.insert_row(row)
+
+    finally:
+        for w in writers.values():
+            w.close()
+
+    for s in sources.values():
+        s.state = s.STATES.INGESTED
+
+    b.commit()
@@ -0,0 +1,207 @@
+"""
+An index of the members of the zip archives in the download cache.
+
+The offsets of the members of each archive are recorded once, keyed by the URL and the
+checksum of the archive from the download manifest, so members can be streamed straight
+out of the stored archive without reading its central directory again, or extracting
+the member to a temporary file.
+
+"""
+
+import io
+
+INDEX_PATH = '_censuslib/zip_index.json'
+
+CHUNK_SIZE = 1024 * 1024
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+class ZipIndex(object):
+    """Record and use the member offsets of zip archives in a cache"""
+
+    def __init__(self, cache, path=INDEX_PATH):
+        from .download import DownloadManifest
+        from .util import load_json
+
+        self.cache = cache
+        self.path = path
+        self.manifest = DownloadManifest(cache)
+
+        self.entries = load_json(self.cache, self.path, {})
+
+    def archive(self, url):
+        """Return the download manifest entry for a URL. The archive must already have been
+        downloaded, with download.download_all(), as the bundles do before they ingest. It
+        isn't downloaded from here, because every generator and pool worker that reads the
+        archive would try to download it at once. """
+
+        if not self.manifest.is_verified(url):
+            # It may have been downloaded by another process since the manifest was loaded
+            self.manifest.reload()
+
+        if not self.manifest.is_verified(url):
+            raise IOError("The archive for {} has not been downloaded; pre-download it with "
+                          "censuslib.download.download_all() before reading it".format(url))
+
+        return self.manifest.get(url)
+
+    def members(self, url):
+        """Return a dict of the index entries for the members of the archive at a URL"""
+
+        archive = self.archive(url)
+
+        e = self.entries.get(url)
+
+        if not e or e['md5'] != archive['md5']:
+            e = dict(md5=archive['md5'], members=self._scan(archive['path']))
+            self.save(url, e)
+
+        return e['members']
+
+    def _scan(self, path):
+        """Read the central directory of an archive, and the local header of each member,
+        to find where the member data starts"""
+        import struct
+        import zipfile
+
+        members = {}
+
+        with self.cache.open(path, 'rb') as f:
+            zf = zipfile.ZipFile(f)
+
+            for info in zf.infolist():
+                f.seek(info.header_offset)
+                fh = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+
+                data_offset = (info.header_offset + zipfile.sizeFileHeader +
+                               fh[zipfile._FH_FILENAME_LENGTH] + fh[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+                members[info.filename] = dict(
+                    offset=data_offset,
+                    compress_type=info.compress_type,
+                    compress_size=info.compress_size,
+                    file_size=info.file_size
+                )
+
+        return members
+
+    def save(self, url, e):
+        """Add the entry for an archive, and save the index. The saved index is read again
+        and merged under a lock, so entries added by other processes are kept. """
+        from .util import update_json
+
+        def merge(entries):
+            entries[url] = e
+            return entries
+
+        self.entries = update_json(self.cache, self.path, merge, {}, indent=2, sort_keys=True)
+
+    def find(self, url, name):
+        """Return the name of the archive member that matches `name`, either exactly, by the
+        base name, or as a regular expression"""
+        import re
+        from os.path import basename
+
+        members = self.members(url)
+
+        if name in members:
+            return name
+
+        for member in sorted(members):
+            if basename(member) == name:
+                return member
+
+        for member in sorted(members):
+            if re.search(name, member):
+                return member
+
+        raise KeyError("No member matching '{}' in {}".format(name, url))
+
+    def open(self, url, name):
+        """Return a buffered binary stream for a member of the archive at a URL"""
+        import zipfile
+
+        member = self.find(url, name)
+        entry = self.members(url)[member]
+
+        if entry['compress_type'] not in (ZIP_STORED, ZIP_DEFLATED):
+            # Let zipfile deal with anything unusual.
+            zf = zipfile.ZipFile(self.cache.open(self.archive(url)['path'], 'rb'))
+            return zf.open(member)
+
+        f = self.cache.open(self.archive(url)['path'], 'rb')
+
+        return io.BufferedReader(MemberStream(f, entry), CHUNK_SIZE)
+
+    def rows(self, url, name):
+        """Yield the rows of a CSV member of the archive at a URL"""
+        import csv
+
+        f = self.open(url, name)
+
+        try:
+            for row in csv.reader(f):
+                yield row
+        finally:
+            f.close()
+
+
+class MemberStream(io.RawIOBase):
+    """Read the data of a stored or deflated zip member, starting from its offset in the
+    archive file"""
+
+    def __init__(self, f, entry):
+        import zlib
+
+        self._f = f
+        self._f.seek(entry['offset'])
+        self._remaining = entry['compress_size']
+
+        if entry['compress_type'] == ZIP_DEFLATED:
+            self._decomp = zlib.decompressobj(-15)
+        else:
+            self._decomp = None
+
+        self._buf = b''
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+
+        while self._pos >= len(self._buf) and self._remaining:
+            chunk = self._f.read(min(CHUNK_SIZE, self._remaining))
+
+            if not chunk:
+                raise IOError("Truncated zip member")
+
+            self._remaining -= len(chunk)
+
+            if self._decomp:
+                self._buf = self._decomp.decompress(chunk)
+                if not self._remaining:
+                    self._buf += self._decomp.flush()
+            else:
+                self._buf = chunk
+
+            self._pos = 0
+
+    def readinto(self, b):
+
+        self._fill()
+
+        n = min(len(b), len(self._buf) - self._pos)
+
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+
+        super(MemberStream, self).close()
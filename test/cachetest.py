@@ -0,0 +1,18 @@
+import unittest
+
+
+class TempCacheTestCase(unittest.TestCase):
+    """A test case with an empty filesystem in a temporary directory, as self.cache, for
+    the tests of the files that are saved in the download cache"""
+
+    def setUp(self):
+        import tempfile
+        from fs.osfs import OSFS
+
+        self.dir = tempfile.mkdtemp()
+        self.cache = OSFS(self.dir)
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.dir)
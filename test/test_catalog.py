@@ -0,0 +1,72 @@
+import unittest
+
+from cachetest import TempCacheTestCase
+
+
+class TestTableCatalog(TempCacheTestCase):
+
+    @staticmethod
+    def rows():
+
+        def row(table_id, seq, title, line='', start='', cells='', is_column='', year=2014, release=5):
+            return dict(year=str(year), release=str(release), table_id=table_id,
+                        sequence_number=str(seq), title=title, line=line, start=start,
+                        table_cells=cells, is_column=is_column, segment_column=line)
+
+        return [
+            row('B00001', 1, 'UNWEIGHTED SAMPLE COUNT', start='7', cells='1'),
+            row('B00001', 1, 'Universe:  Total population'),
+            row('B00001', 1, 'Total', line='1', is_column='Y'),
+            row('B00001', 1, 'Total', line='1', is_column='Y', year=2013),
+            row('B00002', 1, 'UNWEIGHTED SAMPLE HOUSING UNITS', start='8', cells='1'),
+            row('B00002', 1, 'Universe:  Housing units'),
+            row('B00002', 1, 'Total', line='1', is_column='Y'),
+            row('B01001', 2, 'SEX BY AGE', start='7', cells='2'),
+            row('B01001', 2, 'Universe:  Total population'),
+            row('B01001', 2, 'Total:', line='1', is_column='Y'),
+            row('B01001', 2, 'Male:', line='2', is_column='Y'),
+            row('B99999', 200, 'NOT IN THIS RELEASE', start='7', cells='1'),
+        ]
+
+    def test_catalog(self):
+        from censuslib.catalog import TableCatalog
+
+        c = TableCatalog.from_rows(self.rows(), 2014, 5)
+
+        self.assertEqual(['B00001', 'B00002', 'B01001'], list(c.tables.keys()))
+        self.assertEqual(['B00001', 'B00002'], c.sequence(1))
+        self.assertEqual([], c.sequence(3))
+        self.assertEqual([1, 2], c.sequences)
+
+        t = c.table('B01001')
+        self.assertEqual('Total population', t['universe'])
+        self.assertEqual(dict(sequence=2, start=7, length=2), t['data'])
+        self.assertEqual(['B01001001', 'B01001001_m90', 'B01001002', 'B01001002_m90'],
+                         [col['name'] for col in t['columns']])
+
+    def test_duplicate_column(self):
+        from censuslib.catalog import TableCatalog
+
+        rows = self.rows()
+        rows.insert(3, rows[2])
+
+        with self.assertRaises(Exception):
+            TableCatalog.from_rows(rows, 2014, 5)
+
+    def test_cached(self):
+        from censuslib.catalog import TableCatalog
+
+        c1 = TableCatalog.cached(self.cache, 'key', 2014, 5, self.rows)
+
+        def no_rows():
+            raise AssertionError("The catalog should be loaded from the cache")
+
+        c2 = TableCatalog.cached(self.cache, 'key', 2014, 5, no_rows)
+
+        self.assertEqual(c1.tables, c2.tables)
+        self.assertEqual(list(c1.tables.keys()), list(c2.tables.keys()))
+        self.assertEqual(c1.sequence(1), c2.sequence(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
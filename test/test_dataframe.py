@@ -0,0 +1,248 @@
+import unittest
+
+
+def census_frame(n_rows=5, n_cols=4):
+    """A frame laid out like a census table partition: nine id columns, then alternating
+    estimate and margin columns"""
+    import numpy as np
+    import pandas as pd
+    from collections import OrderedDict
+
+    rs = np.random.RandomState(1)
+
+    d = OrderedDict()
+    d['id'] = range(1, n_rows+1)
+    for name in ('stusab', 'chariter', 'sequence', 'logrecno', 'geoid'):
+        d[name] = ['x'] * n_rows
+    d['gvid'] = ['0O{:04d}'.format(i) for i in range(n_rows)]
+    d['sumlevel'] = [50] * n_rows
+    d['jam_flags'] = [None] * n_rows
+
+    for i in range(1, n_cols+1):
+        d['b01001{:03d}'.format(i)] = rs.randint(0, 1000, n_rows).astype(float)
+        d['b01001{:03d}_m90'.format(i)] = rs.randint(0, 100, n_rows).astype(float)
+
+    return pd.DataFrame(d)
+
+
+class TestMelt(unittest.TestCase):
+
+    def test_melt(self):
+        from censuslib.dataframe import melt
+
+        df = census_frame()
+
+        m = melt(df)
+
+        self.assertEqual(['gvid', 'variable'], list(m.index.names))
+        self.assertEqual(['value', 'm90'], list(m.columns))
+        self.assertEqual(5 * 4, len(m))
+
+        for gvid in df.gvid:
+            for i in range(1, 5):
+                col = 'b01001{:03d}'.format(i)
+                self.assertEqual(df.loc[df.gvid == gvid, col].iloc[0], m.loc[(gvid, col), 'value'])
+                self.assertEqual(df.loc[df.gvid == gvid, col + '_m90'].iloc[0],
+                                 m.loc[(gvid, col), 'm90'])
+
+    def test_unpaired(self):
+        from censuslib.dataframe import melt
+
+        df = census_frame()
+        df = df[list(df.columns[:9]) + list(df.columns[10:])]
+
+        with self.assertRaises(ValueError):
+            melt(df)
+
+
+class TestColumnIndex(unittest.TestCase):
+
+    def test_index(self):
+        from censuslib.dataframe import ColumnIndex
+
+        df = census_frame(n_cols=3)
+
+        ci = ColumnIndex(df.columns)
+
+        self.assertEqual('b01001002', ci.name(2))
+        self.assertEqual('b01001002', ci.name('b01001002'))
+        self.assertEqual(11, ci.position(2))
+        self.assertEqual('b01001003_m90', ci.margin(3))
+        self.assertIsNone(ci.margin('gvid'))
+        self.assertEqual(['b01001001', 'b01001002', 'b01001003'], ci.range(1, 3))
+
+        with self.assertRaises(KeyError):
+            ci.name(4)
+
+        with self.assertRaises(KeyError):
+            ci.name('b01001004')
+
+    def test_sum_col_group(self):
+        import numpy as np
+        from censuslib.dataframe import CensusDataFrame
+
+        raw = census_frame()
+        df = CensusDataFrame(raw)
+
+        value, m = df.sum_col_group(2, 4)
+
+        cols = ['b01001002', 'b01001003', 'b01001004']
+
+        self.assertEqual(list(raw[cols[0]] + raw[cols[1]] + raw[cols[2]]), list(value))
+        self.assertTrue(np.allclose(np.sqrt(sum(raw[c + '_m90']**2 for c in cols)), m))
+
+        # The index follows changes to the columns
+        df['b01001005'] = raw['b01001004']
+        self.assertEqual('b01001005', df.column_index.name(5))
+
+
+class TestColumnMeta(unittest.TestCase):
+
+    def test_column_meta(self):
+        from collections import namedtuple
+        from censuslib.dataframe import CensusDataFrame
+
+        Column = namedtuple('Column', 'name description')
+
+        class Table(object):
+            def __init__(self, names):
+                self.columns = [Column(name, 'Column ' + name) for name in names]
+
+            def column(self, name):
+                raise AssertionError("Column metadata should come from the cached map")
+
+        class Partition(object):
+            def __init__(self, names):
+                self.table = Table(names)
+
+        raw = census_frame()
+        df = CensusDataFrame(raw)
+        df.partition = Partition(raw.columns)
+
+        self.assertEqual('Column b01001001', df['b01001001'].ambry_column.description)
+        self.assertEqual('Column b01001002', df.lookup(2).ambry_column.description)
+
+        # Slices and copies share the map
+        sliced = df[['gvid', 'b01001003', 'b01001003_m90']]
+        self.assertIs(df.column_meta, sliced.column_meta)
+        self.assertIs(df.column_meta, df.copy().column_meta)
+        self.assertEqual('Column b01001003', sliced['b01001003'].ambry_column.description)
+
+        # Derived columns have no metadata
+        df['total'] = raw['b01001001'] + raw['b01001002']
+        self.assertIsNone(df['total'].ambry_column)
+
+
+class TestSums(unittest.TestCase):
+
+    def test_sum_m_groups(self):
+        import numpy as np
+        from censuslib.dataframe import CensusDataFrame
+
+        raw = census_frame(n_rows=20, n_cols=6)
+        raw.loc[3, 'b01001002'] = np.nan
+        raw_columns = list(raw.columns)
+
+        df = CensusDataFrame(raw)
+
+        groups = [('a', [1, 2, 3]), ('b', ['b01001004', 'b01001006']), ('c', [5])]
+
+        sums = df.sum_m_groups(groups)
+
+        self.assertEqual(['a', 'a_m90', 'b', 'b_m90', 'c', 'c_m90'], list(sums.columns))
+
+        for name, cols in [('a', ['b01001001', 'b01001002', 'b01001003']),
+                           ('b', ['b01001004', 'b01001006']), ('c', ['b01001005'])]:
+
+            expected = sum(raw[c] for c in cols)
+            expected_m90 = np.sqrt(sum(raw[c + '_m90']**2 for c in cols))
+
+            self.assertTrue(np.allclose(expected, sums[name], equal_nan=True))
+            self.assertTrue(np.allclose(expected_m90, sums[name + '_m90']))
+
+        self.assertTrue(np.isnan(sums['a'][3]))
+
+        df.add_sum_m_groups(groups)
+
+        self.assertTrue(np.allclose(sums['b_m90'], df['b_m90']))
+
+        value, m = df.sum_col_group(4, 6)
+        self.assertTrue(np.allclose(raw.b01001004 + raw.b01001005 + raw.b01001006, value))
+
+        # Existing columns are replaced in place, and new ones are added at the end
+        df.add_sum_m_groups([('d', [1]), ('a', [2])])
+
+        self.assertEqual(raw_columns + ['a', 'a_m90', 'b', 'b_m90', 'c', 'c_m90', 'd', 'd_m90'],
+                         list(df.columns))
+        self.assertTrue(np.allclose(raw.b01001002, df['a'], equal_nan=True))
+        self.assertTrue(np.allclose(raw.b01001001, df['d']))
+        self.assertEqual('d_m90', df.column_index.margin('d'))
+
+    def test_series_arguments(self):
+        """Series are only accepted as columns of the frame itself"""
+        import numpy as np
+        from censuslib.dataframe import CensusDataFrame
+
+        raw = census_frame()
+        df = CensusDataFrame(raw)
+
+        value, m = df.sum_m(df['b01001001'], df.b01001002)
+        self.assertTrue(np.allclose(raw.b01001001 + raw.b01001002, value))
+
+        for s in (raw['b01001001'], df['b01001001'] * 2, df.copy()['b01001001']):
+            with self.assertRaises(ValueError):
+                df.sum_m(s, 'b01001002')
+
+            with self.assertRaises(ValueError):
+                df.ratio(s, 'b01001002')
+
+
+class TestRatios(unittest.TestCase):
+
+    def test_ratio_margins(self):
+        import numpy as np
+        from censuslib.dataframe import ratio_margins
+
+        rate = np.array([0.5, 0.5])
+        n_m90 = np.array([10., 1.])
+        d = np.array([100., 100.])
+        d_m90 = np.array([4., 4.])
+
+        m = ratio_margins(rate, n_m90, d, d_m90)
+
+        # The first uses the proportion formula, the second has a negative argument to the
+        # root, so it falls back to the ratio formula
+        self.assertAlmostEqual(np.sqrt(100 - 0.25 * 16) / 100, m[0])
+        self.assertAlmostEqual(np.sqrt(1 + 0.25 * 16) / 100, m[1])
+
+        m = ratio_margins(rate, n_m90, d, d_m90, subset=False)
+        self.assertAlmostEqual(np.sqrt(100 + 0.25 * 16) / 100, m[0])
+
+    def test_ratios(self):
+        import numpy as np
+        from censuslib.dataframe import CensusDataFrame, ratio_margins
+
+        raw = census_frame(n_rows=50, n_cols=4)
+        df = CensusDataFrame(raw)
+
+        r = df.ratios([('a', 2, 1), ('b', 'b01001003', ('b01001004', 'b01001004_m90'), False)])
+
+        self.assertEqual(['a_rate', 'a_rate_m90', 'b_rate', 'b_rate_m90'], list(r.columns))
+
+        rate = np.round(raw.b01001002 / raw.b01001001, 3)
+        self.assertTrue(np.allclose(rate, r.a_rate, equal_nan=True))
+        self.assertTrue(np.allclose(ratio_margins(rate, raw.b01001002_m90, raw.b01001001,
+                                                  raw.b01001001_m90),
+                                    r.a_rate_m90, equal_nan=True))
+
+        rate = np.round(raw.b01001003 / raw.b01001004, 3)
+        self.assertTrue(np.allclose(ratio_margins(rate, raw.b01001003_m90, raw.b01001004,
+                                                  raw.b01001004_m90, False),
+                                    r.b_rate_m90, equal_nan=True))
+
+        rate, rate_m = df.ratio(2, 1)
+        self.assertTrue(np.allclose(r.a_rate_m90, rate_m, equal_nan=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import unittest
 
+from cachetest import TempCacheTestCase
+
 
 class TestDimensions(unittest.TestCase):
 
@@ -28,3 +30,90 @@ class TestDimensions(unittest.TestCase):
 
         print df.dim()
 
+
+class TestDimensionIndex(unittest.TestCase):
+
+    @staticmethod
+    def table():
+        from collections import namedtuple
+
+        Column = namedtuple('Column', 'name description')
+
+        class Table(object):
+            vid = 'tfake001'
+            description = 'Sex By Age (White Alone)'
+
+        titles = ['Total:', 'Male:', 'Under 5 years', '5 to 9 years', '85 years and over',
+                  'Female:', 'Under 5 years', '20 years', '85 years and over']
+
+        t = Table()
+        t.columns = [Column('h{}'.format(i), 'Header') for i in range(9)]
+
+        for i, title in enumerate(titles, 1):
+            t.columns.append(Column('b01001a{:03d}'.format(i), title))
+            t.columns.append(Column('b01001a{:03d}_m90'.format(i), 'Margin of error for: ' + title))
+
+        return t
+
+    def test_index(self):
+        from censuslib.dimensions import DimensionIndex, classify_table
+
+        t = self.table()
+
+        idx = DimensionIndex.for_table(t)
+
+        self.assertIs(idx, DimensionIndex.for_table(t))
+        self.assertEqual(9, len(idx))
+
+        # Another table object, even with the same vid, has its own index
+        t2 = self.table()
+        t2.columns = t2.columns[:11]
+        self.assertEqual(1, len(DimensionIndex.for_table(t2)))
+        self.assertEqual(9, len(DimensionIndex.for_table(t)))
+
+        classes = classify_table(t)
+        name, row = idx.rows[3]
+        self.assertEqual('b01001a004', name)
+        self.assertEqual(dict(classes[name], col_num=4), row)
+        self.assertEqual(('white', 'male', '05-09', 5, 9), (row['race_eth'], row['sex'], row['age'],
+                                                            row['age_min'], row['age_max']))
+
+        self.assertEqual(['b01001a006', 'b01001a007', 'b01001a008', 'b01001a009'],
+                         idx.columns(sex='female', age_max=[5, 20, 200]))
+
+        self.assertEqual(['b01001a008'], idx.columns("sex == 'female' and age_min >= 18 and age_max < 85"))
+        self.assertEqual(['b01001a005', 'b01001a009'], idx.columns("age_min >= 85", sex=['male', 'female']))
+
+        with self.assertRaises(KeyError):
+            idx.columns(color='red')
+
+
+class TestDimensionCatalog(TempCacheTestCase):
+
+    def tables(self):
+        t1 = TestDimensionIndex.table()
+        t1.name = 'b01001a'
+
+        t2 = TestDimensionIndex.table()
+        t2.name = 'b01001b'
+        t2.description = 'Sex By Age (Black Or African American Alone)'
+
+        return [t1, t2]
+
+    def test_catalog(self):
+        from censuslib.dimensions import DimensionCatalog
+
+        c = DimensionCatalog.cached(self.cache, 'key', self.tables)
+
+        self.assertEqual(['b01001a', 'b01001b'], c.tables)
+        self.assertEqual([('b01001a', 'b01001a008'), ('b01001b', 'b01001a008')],
+                         c.columns("age_min >= 18 and age_max < 85", sex='female'))
+        self.assertEqual([('b01001b', 'b01001a004')], c.columns(race_eth='black', col_num=4))
+
+        def no_tables():
+            raise AssertionError("The catalog should be loaded from the cache")
+
+        c2 = DimensionCatalog.cached(self.cache, 'key', no_tables)
+
+        self.assertEqual(c.rows, c2.rows)
+        self.assertEqual(c.columns(sex='male', age='85+'), c2.columns(sex='male', age='85+'))
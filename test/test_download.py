@@ -0,0 +1,265 @@
+import unittest
+
+from cachetest import TempCacheTestCase
+
+
+class TestDownload(TempCacheTestCase):
+    """Test the bulk downloader against a local HTTP server"""
+
+    files = {
+        '/a/one.zip': b'1' * 100000,
+        '/a/two.zip': b'2' * 3000,
+        '/b/three.zip': b'3' * 50
+    }
+
+    def setUp(self):
+        import threading
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        super(TestDownload, self).setUp()
+
+        files = self.files
+        self.etags = etags = {p: '"{}-1"'.format(p) for p in files}
+        self.requests = requests = []
+        self.truncated = truncated = set()
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = files.get(self.path)
+                rng = self.headers.getheader('Range')
+                if_range = self.headers.getheader('If-Range')
+
+                requests.append((self.path, rng, if_range))
+
+                if body is None:
+                    self.send_error(404)
+                    return
+
+                if rng and if_range and if_range != etags[self.path]:
+                    # The file has changed, so send all of it
+                    rng = None
+
+                if rng:
+                    start = int(rng.replace('bytes=', '').split('-')[0])
+                    if start >= len(body):
+                        self.send_error(416)
+                        return
+                    self.send_response(206)
+                    body = body[start:]
+                else:
+                    self.send_response(200)
+
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etags[self.path])
+                self.end_headers()
+
+                if self.path in truncated:
+                    # Drop the connection part way through the file
+                    truncated.remove(self.path)
+                    body = body[:len(body) // 2]
+
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.root = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        super(TestDownload, self).tearDown()
+
+    def test_download_all(self):
+        from censuslib.download import download_all, cache_path, DownloadManifest
+
+        urls = [self.root + p for p in sorted(self.files)]
+
+        download_all(urls + urls, self.cache, processes=3)
+
+        # Duplicates are only fetched once
+        self.assertEqual(3, len(self.requests))
+
+        for p, body in self.files.items():
+            with self.cache.open(cache_path(self.root + p), 'rb') as f:
+                self.assertEqual(body, f.read())
+
+        m = DownloadManifest(self.cache)
+        for url in urls:
+            self.assertTrue(m.is_verified(url, check_md5=True))
+
+        # Verified files aren't fetched again.
+        download_all(urls, self.cache, processes=3)
+        self.assertEqual(3, len(self.requests))
+
+    def partial(self, p, contents, validator=None):
+        """Leave a part file in the cache, as an interrupted download would"""
+        from censuslib.download import cache_path
+
+        path = cache_path(self.root + p)
+
+        self.cache.makedir('/'.join(path.split('/')[:-1]), recursive=True, allow_recreate=True)
+        self.cache.setcontents(path + '.part', contents)
+
+        if validator:
+            self.cache.setcontents(path + '.part.validator', validator)
+
+        return path
+
+    def assertDownloaded(self, p):
+        from censuslib.download import cache_path, DownloadManifest
+
+        path = cache_path(self.root + p)
+
+        with self.cache.open(path, 'rb') as f:
+            self.assertEqual(self.files[p], f.read())
+
+        self.assertTrue(DownloadManifest(self.cache).is_verified(self.root + p, check_md5=True))
+        self.assertFalse(self.cache.exists(path + '.part'))
+        self.assertFalse(self.cache.exists(path + '.part.validator'))
+
+    def test_resume(self):
+        from censuslib.download import download_all
+
+        body = self.files['/a/one.zip']
+
+        self.partial('/a/one.zip', body[:1000], self.etags['/a/one.zip'])
+
+        download_all([self.root + '/a/one.zip'], self.cache)
+
+        self.assertEqual([('/a/one.zip', 'bytes=1000-', self.etags['/a/one.zip'])], self.requests)
+        self.assertDownloaded('/a/one.zip')
+
+    def test_interrupted(self):
+        """An interrupted download keeps its validator, and is resumed by the next run"""
+        from censuslib.download import download_all
+
+        self.truncated.add('/a/one.zip')
+
+        with self.assertRaises(IOError):
+            download_all([self.root + '/a/one.zip'], self.cache)
+
+        download_all([self.root + '/a/one.zip'], self.cache)
+
+        self.assertEqual([('/a/one.zip', None, None),
+                          ('/a/one.zip', 'bytes=50000-', self.etags['/a/one.zip'])], self.requests)
+        self.assertDownloaded('/a/one.zip')
+
+    def test_resume_changed(self):
+        """A part file from an earlier version of the file is replaced, not appended to"""
+        from censuslib.download import download_all
+
+        self.partial('/a/one.zip', b'x' * 1000, self.etags['/a/one.zip'])
+        self.etags['/a/one.zip'] = '"/a/one.zip-2"'
+
+        download_all([self.root + '/a/one.zip'], self.cache)
+
+        self.assertEqual([('/a/one.zip', 'bytes=1000-', '"/a/one.zip-1"')], self.requests)
+        self.assertDownloaded('/a/one.zip')
+
+    def test_resume_unknown_validator(self):
+        """A part file without a validator is downloaded again from the start"""
+        from censuslib.download import download_all
+
+        self.partial('/a/one.zip', b'x' * 1000)
+
+        download_all([self.root + '/a/one.zip'], self.cache)
+
+        self.assertEqual([('/a/one.zip', None, None)], self.requests)
+        self.assertDownloaded('/a/one.zip')
+
+    def test_unrecorded_complete_file(self):
+        """A file that is in the cache, but not the manifest, can't be checked against the
+        server, so it is downloaded again"""
+        from censuslib.download import download_all, cache_path
+
+        url = self.root + '/b/three.zip'
+        path = cache_path(url)
+
+        self.cache.makedir('/'.join(path.split('/')[:-1]), recursive=True, allow_recreate=True)
+        self.cache.setcontents(path, b'x' * 50)
+
+        download_all([url], self.cache)
+
+        self.assertEqual([('/b/three.zip', None, None)], self.requests)
+        self.assertDownloaded('/b/three.zip')
+
+    def test_complete_part_file(self):
+        """A part file that has all of the file is checked with a range request"""
+        from censuslib.download import download_all
+
+        self.partial('/b/three.zip', self.files['/b/three.zip'], self.etags['/b/three.zip'])
+
+        download_all([self.root + '/b/three.zip'], self.cache)
+
+        self.assertEqual([('/b/three.zip', 'bytes=50-', self.etags['/b/three.zip'])], self.requests)
+        self.assertDownloaded('/b/three.zip')
+
+    def test_stale_manifests(self):
+        """Manifests loaded before another process records a download don't drop its entry
+        when they save"""
+        from censuslib.download import DownloadManifest, fetch
+
+        urls = [self.root + p for p in sorted(self.files)]
+
+        m1 = DownloadManifest(self.cache)
+        m2 = DownloadManifest(self.cache)
+
+        fetch(urls[0], self.cache, m1)
+        fetch(urls[1], self.cache, m2)
+
+        self.assertEqual(set(urls[:2]), set(m2.entries))
+
+        m = DownloadManifest(self.cache)
+        self.assertTrue(m.is_verified(urls[0]) and m.is_verified(urls[1]))
+
+        # No temp files are left behind
+        self.assertEqual([], [p for p in self.cache.walkfiles() if p.endswith('.tmp')])
+
+    def test_concurrent_fetch(self):
+        """Several fetches of a URL at once, each with its own manifest, only download it once"""
+        import threading
+        from censuslib.download import DownloadManifest, fetch
+
+        url = self.root + '/a/one.zip'
+
+        threads = [threading.Thread(target=fetch, args=(url, self.cache, DownloadManifest(self.cache)))
+                   for i in range(4)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual([('/a/one.zip', None, None)], self.requests)
+        self.assertTrue(DownloadManifest(self.cache).is_verified(url, check_md5=True))
+
+    def test_progress(self):
+        import censuslib.download as download
+
+        messages = []
+
+        interval, download.PROGRESS_INTERVAL = download.PROGRESS_INTERVAL, 0
+        chunk_size, download.CHUNK_SIZE = download.CHUNK_SIZE, 40000
+
+        try:
+            download.download_all([self.root + '/a/one.zip'], self.cache, log=messages.append)
+        finally:
+            download.PROGRESS_INTERVAL, download.CHUNK_SIZE = interval, chunk_size
+
+        url = self.root + '/a/one.zip'
+
+        self.assertEqual(['Downloading {}; {} bytes'.format(url, n) for n in (40000, 80000, 100000)],
+                         [m for m in messages if m.startswith('Downloading ')])
+
+
+if __name__ == '__main__':
+    unittest.main()
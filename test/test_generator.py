@@ -0,0 +1,453 @@
+import unittest
+
+from cachetest import TempCacheTestCase
+
+HEADER_COLS = [('STUSAB', '', 2, 'str', 2), ('CHARITER', '', 3, 'str', 3),
+               ('SEQUENCE', '', 4, 'int', 4), ('LOGRECNO', '', 7, 'int', 5)]
+
+
+def census_table(name, start, length):
+    """A stand-in for a table, with the columns and the sequence file positions that the
+    slicers use"""
+    from collections import namedtuple
+
+    Column = namedtuple('Column', 'name')
+    Table = namedtuple('Table', 'name data columns')
+
+    names = ['id', 'stusab', 'chariter', 'sequence', 'logrecno', 'geoid', 'gvid', 'sumlevel',
+             'jam_flags']
+    for i in range(1, length + 1):
+        names += ['{}{:03d}'.format(name, i), '{}{:03d}_m90'.format(name, i)]
+
+    return Table(name, dict(start=start, length=length), [Column(n) for n in names])
+
+
+def sequence_rows(prefix, logrecnos, stusab='ca', width=12):
+    """Rows of an estimate ( prefix 'e' ) or margin sequence file, with numeric values"""
+    return [['ACSSF', '2014e5', stusab, '000', '0001', '{:07d}'.format(i)] +
+            [str(i * 100 + j) if prefix == 'e' else str(j / 10.0) for j in range(6, width)]
+            for i in logrecnos]
+
+
+def table_slicer():
+    from censuslib.generator import TableSlicer
+
+    return TableSlicer(census_table('b01001', 7, 3), HEADER_COLS)
+
+
+def sliced_blocks(slicer, states, block_size=30):
+    """Sliced blocks for several states, as the generator yields them"""
+    from censuslib.generator import slice_sources
+
+    for stusab, n in states:
+        e = sequence_rows('e', range(1, n + 1), stusab)
+        m = sequence_rows('m', range(1, n + 1), stusab)
+
+        for n, block in slice_sources(e, m, slicer, block_size):
+            yield n, block
+
+
+class TestMergeJoin(unittest.TestCase):
+
+    @staticmethod
+    def rows(prefix, logrecnos, stusab='ca'):
+        return [['ACSSF', '2014e5', stusab, '000', '0001', '{:07d}'.format(i), prefix + str(i)]
+                for i in logrecnos]
+
+    def test_aligned(self):
+        from collections import Counter
+        from censuslib.generator import merge_join
+
+        e = self.rows('e', range(1, 100))
+        m = self.rows('m', range(1, 100))
+
+        counts = Counter()
+        pairs = list(merge_join(e, m, (2, 5), counts))
+
+        self.assertEqual(list(zip(e, m)), pairs)
+        self.assertEqual(99, counts['matched'])
+        self.assertEqual(0, counts['unmatched_estimates'])
+        self.assertEqual(0, counts['unmatched_margins'])
+
+    def test_drift(self):
+        from collections import Counter
+        from censuslib.generator import merge_join
+
+        e = self.rows('e', [1, 2, 3, 5, 6, 9, 10])
+        m = self.rows('m', [1, 3, 4, 5, 6, 7, 10, 11], stusab='CA')
+
+        counts = Counter()
+        pairs = list(merge_join(e, m, (2, 5), counts))
+
+        self.assertEqual([(r1[-1], r2[-1]) for r1, r2 in pairs],
+                         [('e1', 'm1'), ('e3', 'm3'), ('e5', 'm5'), ('e6', 'm6'), ('e10', 'm10')])
+        self.assertEqual(5, counts['matched'])
+        self.assertEqual(2, counts['unmatched_estimates'])
+        self.assertEqual(3, counts['unmatched_margins'])
+
+    def test_unsorted(self):
+        from censuslib.generator import merge_join
+
+        e = self.rows('e', [1, 5, 2])
+        m = self.rows('m', [1, 3, 4, 6, 7])
+
+        with self.assertRaises(ValueError):
+            list(merge_join(e, m, (2, 5)))
+
+
+class TestSlicers(unittest.TestCase):
+
+    @staticmethod
+    def rows(prefix, n, width=20):
+        return [['ACSSF', '2014e5', 'ca', '000', '0001', '{:07d}'.format(i)] +
+                ['{}{}.{}'.format(prefix, i, j) for j in range(6, width)] for i in range(n)]
+
+    def test_slice_block(self):
+        """The block slicer matches the row by row Slice and interleave that it replaced"""
+        import numpy as np
+        from itertools import chain
+        from ambry.etl import Slice
+        from censuslib.generator import TableSlicer
+
+        e, m = self.rows('e', 50), self.rows('m', 50)
+
+        for start, length in [(7, 1), (7, 5), (12, 8)]:
+            slca, _ = Slice.make_slicer(','.join(str(c[4]) for c in HEADER_COLS))
+            slcb, _ = Slice.make_slicer('{}:{}'.format(start - 1, start + length - 1))
+
+            expected = [slca(row1) + tuple(chain(*zip(slcb(row1), slcb(row2))))
+                        for row1, row2 in zip(e, m)]
+
+            slicer = TableSlicer(census_table('b01001', start, length), HEADER_COLS)
+            block = slicer.slice_block(np.array(e, dtype=object), np.array(m, dtype=object))
+
+            self.assertEqual(expected, [tuple(row) for row in block.tolist()])
+
+            # The headers include the jam_flags column that decode_block() adds
+            self.assertEqual(len(HEADER_COLS) + 1 + 2 * length, len(slicer.headers))
+
+    def test_limit_blocks(self):
+        from censuslib.generator import TableSlicer, SequenceSlicer, slice_sources, limit_blocks
+
+        t1 = TableSlicer(census_table('b01001', 7, 2), HEADER_COLS)
+        t2 = TableSlicer(census_table('b01002', 9, 3), HEADER_COLS)
+
+        e, m = self.rows('e', 100), self.rows('m', 100)
+
+        blocks = list(limit_blocks(slice_sources(e, m, t1, 30), t1, 45))
+        self.assertEqual([30, 15], [n for n, block in blocks])
+        self.assertEqual([30, 15], [len(block) for n, block in blocks])
+
+        blocks = list(limit_blocks(slice_sources(e, m, t1, 30), t1, 60))
+        self.assertEqual([30, 30], [n for n, block in blocks])
+
+        self.assertEqual(4, len(list(limit_blocks(slice_sources(e, m, t1, 30), t1))))
+
+        slicer = SequenceSlicer([('b01001', t1), ('b01002', t2)])
+
+        (n, sliced), = list(limit_blocks(slice_sources(e, m, slicer, 30), slicer, 7))
+        self.assertEqual(7, n)
+        self.assertEqual([('b01001', 7), ('b01002', 7)], [(t, len(b)) for t, b in sliced])
+
+
+class TestReceiveBlocks(unittest.TestCase):
+
+    class Queue(object):
+        """A queue whose first get() times out, as if the worker finished just after"""
+
+        def __init__(self, messages):
+            self.messages = list(messages)
+            self.timed_out = False
+
+        def get(self, timeout=None):
+            from Queue import Empty
+
+            if not self.timed_out:
+                self.timed_out = True
+                raise Empty()
+
+            return self.messages.pop(0)
+
+        def get_nowait(self):
+            from Queue import Empty
+
+            if not self.messages:
+                raise Empty()
+
+            return self.messages.pop(0)
+
+    class Result(object):
+
+        def __init__(self, error=None):
+            self.error = error
+
+        def ready(self):
+            return True
+
+        def get(self):
+            if self.error:
+                raise self.error
+
+    def reader(self):
+        from collections import Counter
+        from censuslib.generator import ACS09StateFileReader
+
+        r = ACS09StateFileReader.__new__(ACS09StateFileReader)
+        r.join_counts = Counter()
+
+        return r
+
+    def test_finished_after_timeout(self):
+        from collections import Counter, namedtuple
+
+        Spec = namedtuple('Spec', 'url file')
+        spec = Spec('http://example.com/AlaskaL.zip', 'e20145ak0001000.txt')
+
+        r = self.reader()
+        q = self.Queue([('block', 2, 'a'), ('block', 1, 'b'), ('done', Counter(matched=3))])
+
+        self.assertEqual([(2, 'a'), (1, 'b')], list(r._receive_blocks(spec, q, self.Result())))
+        self.assertEqual(3, r.join_counts['matched'])
+
+        # A worker that returned without finishing is still an error
+        q = self.Queue([('block', 2, 'a')])
+
+        with self.assertRaises(RuntimeError):
+            list(r._receive_blocks(spec, q, self.Result()))
+
+        # As is a worker that failed
+        with self.assertRaises(IOError):
+            list(r._receive_blocks(spec, self.Queue([]), self.Result(IOError("Failed"))))
+
+
+class TestRecordBatch(unittest.TestCase):
+
+    def test_batches(self):
+        """Batches have the requested size across block and state boundaries, and have the
+        same rows as the blocks"""
+        import numpy as np
+        from censuslib.generator import batch_blocks
+
+        slicer = table_slicer()
+        n_header = len(slicer.header_positions)
+        states = [('ca', 100), ('ak', 45), ('wy', 7)]
+
+        expected = [row for n, block in sliced_blocks(slicer, states) for row in block.tolist()]
+
+        for size, sizes in [(25, [25] * 6 + [2]), (70, [70, 70, 12]), (30, [30] * 5 + [2]),
+                            (500, [152])]:
+
+            batches = list(batch_blocks(sliced_blocks(slicer, states), size, slicer.headers, n_header))
+
+            self.assertEqual(sizes, [len(b) for b in batches])
+
+            header_values = np.concatenate([b.header_values for b in batches])
+            data = np.concatenate([b.data for b in batches])
+
+            self.assertEqual([r[:n_header] for r in expected], header_values.tolist())
+            self.assertEqual([[float(v) for v in r[n_header:]] for r in expected], data.tolist())
+
+    def test_jams(self):
+        import numpy as np
+        from censuslib.generator import RecordBatch
+
+        slicer = table_slicer()
+
+        e = sequence_rows('e', range(1, 4))
+        m = sequence_rows('m', range(1, 4))
+        e[0][7] = '.'
+        m[2][6] = ' '
+        m[2][8] = '.'
+
+        block = slicer.slice_block(np.array(e, dtype=object), np.array(m, dtype=object))
+
+        batch = RecordBatch.from_block(slicer.headers, block, len(slicer.header_positions))
+
+        self.assertEqual(['1m', None, '1N1m'], batch.jam_flags)
+        self.assertEqual(['1m', None, '1N1m'], list(batch['jam_flags']))
+        self.assertTrue(np.isnan(batch['b01001002'][0]))
+        self.assertTrue(np.isnan(batch['b01001001_m90'][2]))
+        self.assertEqual(3, np.isnan(batch.data).sum())
+        self.assertEqual(308.0, batch['b01001003'][2])
+
+    def test_decode_block(self):
+        """The decoded rows are the same as running the jam_float transform on each data
+        value, and the jam_values transform for the jam_flags column"""
+        import numpy as np
+        from censuslib.generator import decode_block
+        from censuslib.transforms import JamValueMixin
+
+        slicer = table_slicer()
+        n_header = len(slicer.header_positions)
+
+        e = sequence_rows('e', range(1, 5))
+        m = sequence_rows('m', range(1, 5))
+        e[0][7] = '.'
+        m[2][6] = ' '
+        m[2][8] = '.'
+        e[3][6] = ''
+
+        block = slicer.slice_block(np.array(e, dtype=object), np.array(m, dtype=object))
+
+        j = JamValueMixin()
+
+        expected = []
+        for row in block.tolist():
+            errors = {}
+            values = [j.jam_float(v, errors, row) for v in row[n_header:]]
+            expected.append(tuple(row[:n_header]) + (j.jam_values(errors, row),) + tuple(values))
+
+        rows = decode_block(block, n_header, JamValueMixin.jam_map)
+
+        self.assertEqual(expected, rows)
+        self.assertEqual(len(slicer.headers), len(rows[0]))
+        self.assertEqual(['1m', None, '1N1m', '1N'], [r[slicer.headers.index('jam_flags')] for r in rows])
+
+        # Blocks without jams have no flags
+        block, = [b for n, b in sliced_blocks(slicer, [('ca', 10)])]
+        self.assertEqual([None] * 10, [r[n_header] for r in decode_block(block, n_header, j.jam_map)])
+
+    def test_to_dataframe(self):
+        import numpy as np
+        from censuslib.generator import RecordBatch
+
+        slicer = table_slicer()
+
+        block, = [b for n, b in sliced_blocks(slicer, [('ca', 10)])]
+        batch = RecordBatch.from_block(slicer.headers, block, len(slicer.header_positions))
+
+        df = batch.to_dataframe()
+
+        self.assertEqual(['stusab', 'chariter', 'sequence', 'logrecno', 'jam_flags',
+                          'b01001001', 'b01001001_m90', 'b01001002', 'b01001002_m90',
+                          'b01001003', 'b01001003_m90'], list(df.columns))
+
+        for name in slicer.headers:
+            self.assertEqual(list(batch[name]), list(df[name]))
+
+        self.assertEqual(list(np.arange(1, 11) * 100 + 8.0), list(df.b01001003))
+
+        with self.assertRaises(KeyError):
+            batch['b01001004']
+
+
+class TestStateCheckpoints(TempCacheTestCase):
+
+    def setUp(self):
+        from collections import namedtuple
+
+        super(TestStateCheckpoints, self).setUp()
+
+        # The checkpoints are in the build directory, not the download cache, but a temporary
+        # directory will do for either
+        self.fs = self.cache
+
+        Spec = namedtuple('Spec', 'url file')
+        self.spec = Spec('http://example.com/files/AlaskaL.zip', 'e20145ak0001000.txt')
+
+        self.slicer = table_slicer()
+
+        self.md5 = {self.spec.url: 'd41d8cd98f00b204e9800998ecf8427e'}
+
+    def archive(self, url):
+        """Stands in for ZipIndex.archive(), returning the manifest entry for the archive"""
+        return dict(md5=self.md5[url])
+
+    def blocks(self, n=100):
+        return list(sliced_blocks(self.slicer, [('ak', n)]))
+
+    def checkpoints(self):
+        from censuslib.generator import StateCheckpoints
+
+        return StateCheckpoints(self.fs, 'b01001', self.slicer, self)
+
+    def tmp_files(self):
+        return [p for p in self.fs.walkfiles() if p.endswith('.tmp')]
+
+    def assertBlocksEqual(self, expected, blocks):
+        self.assertEqual([(n, b.tolist()) for n, b in expected], [(n, b.tolist()) for n, b in blocks])
+
+    def test_replay(self):
+        cp = self.checkpoints()
+        blocks = self.blocks()
+
+        self.assertFalse(cp.exists(self.spec))
+        self.assertBlocksEqual(blocks, cp.save(self.spec, iter(blocks)))
+        self.assertTrue(cp.exists(self.spec))
+
+        # A new run reads the state back from the checkpoint
+        cp = self.checkpoints()
+        self.assertTrue(cp.exists(self.spec))
+        self.assertBlocksEqual(blocks, cp.load(self.spec))
+
+        self.assertEqual([], self.tmp_files())
+
+    def test_interrupted(self):
+        """A state that isn't finished has no checkpoint, and leaves no temp file"""
+        cp = self.checkpoints()
+
+        g = cp.save(self.spec, iter(self.blocks()))
+        next(g)
+        g.close()
+
+        self.assertFalse(cp.exists(self.spec))
+        self.assertEqual([], self.tmp_files())
+
+        def failing():
+            for block in self.blocks():
+                yield block
+                raise IOError("Interrupted")
+
+        with self.assertRaises(IOError):
+            list(cp.save(self.spec, failing()))
+
+        self.assertFalse(cp.exists(self.spec))
+        self.assertEqual([], self.tmp_files())
+
+    def test_leftover_tmp(self):
+        """The temp file of a run that was killed isn't used as a checkpoint, and is replaced
+        by the next run"""
+        cp = self.checkpoints()
+        blocks = self.blocks()
+
+        self.fs.makedir(cp.dir, recursive=True, allow_recreate=True)
+        self.fs.setcontents(cp.path(self.spec) + '.tmp', b'partial')
+
+        self.assertFalse(cp.exists(self.spec))
+
+        list(cp.save(self.spec, iter(blocks)))
+
+        self.assertBlocksEqual(blocks, cp.load(self.spec))
+        self.assertEqual([], self.tmp_files())
+
+    def test_clear(self):
+        cp = self.checkpoints()
+
+        list(cp.save(self.spec, iter(self.blocks())))
+        self.fs.setcontents(cp.path(self.spec)[:-4] + '-other.pkl.tmp', b'partial')
+
+        cp.clear()
+
+        self.assertFalse(cp.exists(self.spec))
+        self.assertEqual([], list(self.fs.walkfiles()))
+
+        # Checkpoints for a different table layout are kept apart
+        from censuslib.generator import StateCheckpoints, TableSlicer
+
+        other = TableSlicer(census_table('b01001', 7, 2), HEADER_COLS)
+        self.assertNotEqual(cp.dir, StateCheckpoints(self.fs, 'b01001', other, self).dir)
+
+    def test_archive_changed(self):
+        """A checkpoint isn't used once the archive has been downloaded again with other contents"""
+        cp = self.checkpoints()
+
+        list(cp.save(self.spec, iter(self.blocks())))
+        self.assertTrue(cp.exists(self.spec))
+
+        self.md5[self.spec.url] = '0cc175b9c0f1b6a831c399e269772661'
+
+        self.assertFalse(self.checkpoints().exists(self.spec))
+
+
+if __name__ == '__main__':
+    unittest.main()
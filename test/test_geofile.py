@@ -0,0 +1,162 @@
+import unittest
+
+# name, start, width, datatype of the columns of a small fixed width geofile
+LAYOUT = [('stusab', 1, 2, 'str'), ('sumlevel', 3, 3, 'int'), ('logrecno', 6, 7, 'int'),
+          ('name', 13, 10, 'str'), ('filler', 23, 4, 'str'), ('arealand', 27, 6, 'float')]
+
+
+def fixed_width_line(stusab, sumlevel, logrecno, name, arealand, eol=b'\r\n'):
+    return (stusab.ljust(2) + str(sumlevel).rjust(3) + str(logrecno).rjust(7) + name.ljust(10) +
+            b'xxxx' + str(arealand).rjust(6) + eol)
+
+
+class TestColumnTypes(unittest.TestCase):
+
+    def test_column_types(self):
+        from censuslib.geofile import column_types, widen_types, EMPTY, INT, FLOAT, STR
+
+        rows = [['ACSSF', '1', '', '1'],
+                ['ACSSF', '2', '', '1.5', ''],
+                ['ACSSF', 'x', ' ', '2', '3']]
+
+        self.assertEqual([STR, STR, EMPTY, FLOAT, INT], column_types(rows))
+        self.assertEqual([STR, INT, EMPTY, INT], column_types(rows[:1]))
+
+        self.assertEqual([STR, STR, FLOAT, FLOAT, INT],
+                         widen_types(column_types(rows), [INT, INT, FLOAT]))
+
+
+class TestColumnUsage(unittest.TestCase):
+
+    def test_column_usage(self):
+        from censuslib.geofile import column_usage
+
+        headers = ['sumlevel', 'a', 'b', 'c']
+
+        rows = [['40', 'x', '', None],
+                ['50', '', 'y', 0],
+                ['40', '', None, ''],
+                [50, '', '', 0],
+                ['140', None, None, None]]
+
+        for block_size in (1, 2, 10):
+            self.assertEqual({40: {'sumlevel', 'a'}, 50: {'sumlevel', 'b'}, 140: {'sumlevel'}},
+                             column_usage(headers, rows, block_size))
+
+    def test_ingested_and_built(self):
+        """The strings of an ingested file, cast to the column datatypes, have the same usage
+        as the typed rows of the built partition"""
+        from censuslib.geofile import column_usage
+
+        headers = ['sumlevel', 'name', 'pop', 'area', 'flag']
+        datatypes = ['int', 'str', 'int', 'float', 'int']
+
+        ingested = [['040', 'Alaska', '00', '0.0', 'x'],
+                    ['050', '', '12', '', ''],
+                    ['050', 'Kenai', '0', ' 1.5', '0'],
+                    ['140', '', '', '0', '1.5']]
+
+        built = [[40, 'Alaska', 0, 0.0, None],
+                 [50, '', 12, None, None],
+                 [50, 'Kenai', 0, 1.5, 0],
+                 [140, '', None, 0.0, None]]
+
+        expected = {40: {'sumlevel', 'name'}, 50: {'sumlevel', 'name', 'pop', 'area'}, 140: {'sumlevel'}}
+
+        self.assertEqual(expected, column_usage(headers, built))
+
+        for block_size in (1, 3, 10):
+            self.assertEqual(expected, column_usage(headers, ingested, block_size, datatypes))
+
+
+class TestFixedWidthReader(unittest.TestCase):
+
+    def test_read(self):
+        from censuslib.geofile import FixedWidthReader
+
+        lines = [fixed_width_line(b'CA', 40, 1, b'California', 1.5),
+                 fixed_width_line(b'NM', 160, 23, b'Espa\xf1ola', 20, eol=b'\n'),
+                 fixed_width_line(b'NM', 160, 24, b'', b'', eol=b''),
+                 fixed_width_line(b'NM', 160, 25, b'Abc', b'n/a'),
+                 fixed_width_line(b'NM', b'', b'x', b'Short', 0)[:20] + b'\r\n']
+
+        expected = [(u'CA', 40, 1, u'California', 1.5),
+                    (u'NM', 160, 23, u'Espa\xf1ola', 20.0),
+                    (u'NM', 160, 24, u'', None),
+                    (u'NM', 160, 25, u'Abc', None),
+                    (u'NM', None, None, u'Short', None)]
+
+        columns = [c for c in LAYOUT if c[0] != 'filler']
+
+        for block_size in (1, 2, 100):
+            reader = FixedWidthReader(columns, block_size=block_size)
+
+            self.assertEqual(['stusab', 'sumlevel', 'logrecno', 'name', 'arealand'], reader.headers)
+            self.assertEqual(expected, list(reader(lines)))
+
+    def test_subset(self):
+        """Only the given columns are read, in the given order"""
+        from censuslib.geofile import FixedWidthReader
+
+        reader = FixedWidthReader([('logrecno', 6, 7, 'int'), ('stusab', 1, 2, 'str')])
+
+        self.assertEqual([(1, u'CA'), (2, u'AK')],
+                         list(reader([fixed_width_line(b'CA', 40, 1, b'California', 1.5),
+                                      fixed_width_line(b'AK', 40, 2, b'Alaska', 2.5)])))
+
+
+class TestSumlevelRouter(unittest.TestCase):
+
+    def bundle(self):
+        from collections import namedtuple
+
+        SourceColumn = namedtuple('SourceColumn', 'source_header start width datatype position')
+        Column = namedtuple('Column', 'name')
+        Table = namedtuple('Table', 'name columns')
+
+        class Bundle(object):
+            tables = [Table('geofile', [Column(c[0]) for c in LAYOUT]),
+                      Table('geofile40', [Column('stusab'), Column('logrecno'), Column('name')]),
+                      Table('geofile50', [Column('stusab'), Column('logrecno'), Column('sumlevel'),
+                                          Column('arealand')])]
+
+            def source_table(self, name):
+                assert name == 'geofile'
+                SourceTable = namedtuple('SourceTable', 'columns')
+                # In reverse, to check that the columns are ordered by position
+                return SourceTable([SourceColumn(*(c + (i + 1,))) for i, c in reversed(list(enumerate(LAYOUT)))])
+
+        return Bundle()
+
+    def test_route(self):
+        from censuslib.geofile import SumlevelRouter
+
+        router = SumlevelRouter(self.bundle())
+
+        self.assertEqual([40, 50], sorted(router.tables))
+
+        # Only the columns of the summary level tables are read
+        self.assertEqual(['stusab', 'sumlevel', 'logrecno', 'name', 'arealand'], router.reader.headers)
+        self.assertEqual({40: ['stusab', 'logrecno', 'name'],
+                          50: ['stusab', 'logrecno', 'sumlevel', 'arealand']}, router.headers)
+
+        lines = [fixed_width_line(b'CA', 40, 1, b'California', 1.5),
+                 fixed_width_line(b'CA', 50, 2, b'Alameda', 2.5),
+                 fixed_width_line(b'CA', 140, 3, b'Tract 1', 3.5),
+                 fixed_width_line(b'CA', b'', 4, b'Blank', 4.5),
+                 fixed_width_line(b'AK', 50, 5, b'Aleutians', 5.5),
+                 fixed_width_line(b'AK', 40, 6, b'Alaska', 6.5)]
+
+        router.reader.block_size = 4
+
+        routed = list(router.route(lines))
+
+        self.assertEqual([(40, (u'CA', 1, u'California')), (40, (u'AK', 6, u'Alaska'))],
+                         [r for r in routed if r[0] == 40])
+        self.assertEqual([(50, (u'CA', 2, 50, 2.5)), (50, (u'AK', 5, 50, 5.5))],
+                         [r for r in routed if r[0] == 50])
+        self.assertEqual(4, len(routed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+from cachetest import TempCacheTestCase
+
+
+class TestGeofileIndex(TempCacheTestCase):
+
+    def rows(self):
+        rows = []
+
+        # Contiguous logrecnos for CA, with gaps for AK, in no particular order
+        for i in reversed(range(1, 501)):
+            rows.append(('ca', '{:07d}'.format(i), '14000US06{:09d}'.format(i), '2g{}'.format(i), 140))
+
+        for i in range(1, 200, 3):
+            rows.append(('AK', i, '05000US02{:03d}'.format(i), '2a{}'.format(i), 50))
+
+        return rows
+
+    def test_lookup(self):
+        from censuslib.geoindex import GeofileIndex
+
+        idx = GeofileIndex.from_rows(self.rows())
+
+        self.assertEqual(len(self.rows()), len(idx))
+        self.assertTrue(idx.states['CA'][3])
+        self.assertFalse(idx.states['AK'][3])
+
+        for stusab, logrecno, geoid, gvid, sumlevel in self.rows():
+            self.assertEqual((geoid, gvid, sumlevel), idx.lookup(stusab.lower(), logrecno))
+
+        for key in [('ca', 501), ('ca', 0), ('ak', 2), ('ak', 500), ('wy', 1)]:
+            with self.assertRaises(KeyError):
+                idx.lookup(*key)
+
+    def test_lookup_block(self):
+        from censuslib.geoindex import GeofileIndex
+
+        rows = self.rows()
+        idx = GeofileIndex.from_rows(rows)
+
+        geoids, gvids, sumlevels = idx.lookup_block([r[0] for r in rows], [int(r[1]) for r in rows])
+
+        self.assertEqual([r[2] for r in rows], list(geoids))
+        self.assertEqual([r[3] for r in rows], list(gvids))
+        self.assertEqual([r[4] for r in rows], list(sumlevels))
+
+        with self.assertRaises(KeyError):
+            idx.lookup_block(['ca', 'ak'], [1, 2])
+
+    def test_cached(self):
+        import numpy as np
+        from censuslib.geoindex import GeofileIndex
+
+        idx = GeofileIndex.cached(self.cache, 'geofile-v1', self.rows)
+
+        self.assertIsInstance(idx.geoids, np.memmap)
+        self.assertEqual(('14000US06000000042', '2g42', 140), idx.lookup('CA', 42))
+
+        def fail():
+            raise AssertionError("Should have loaded the saved index")
+
+        idx = GeofileIndex.cached(self.cache, 'geofile-v1', fail)
+        self.assertEqual(idx.states, GeofileIndex.from_rows(self.rows()).states)
+        self.assertEqual(('05000US02004', '2a4', 50), idx.lookup('AK', 4))
+
+    def test_geofile_rows(self):
+        """Geoids that can't be converted get an empty gvid, and are counted"""
+        from collections import namedtuple
+        import censuslib.geoindex as geoindex
+
+        Row = namedtuple('Row', 'stusab logrecno geoid sumlevel')
+
+        rows = [Row('ca', 1, '04000US06', 40), Row('ca', 2, 'bogus', 50), Row('ca', 3, None, 50)]
+
+        def acs_gvid(geoid):
+            if geoid != '04000US06':
+                raise ValueError(geoid)
+            return '0O06'
+
+        messages = []
+
+        real, geoindex.acs_gvid = geoindex.acs_gvid, acs_gvid
+
+        try:
+            index_rows = list(geoindex.geofile_rows(rows, messages.append))
+        finally:
+            geoindex.acs_gvid = real
+
+        self.assertEqual([('ca', 1, '04000US06', '0O06', 40), ('ca', 2, 'bogus', '', 50),
+                          ('ca', 3, None, '', 50)], index_rows)
+        self.assertEqual(1, len(messages))
+        self.assertTrue(messages[0].startswith('2 '))
+
+        idx = geoindex.GeofileIndex.from_rows(index_rows)
+        self.assertEqual(('bogus', '', 50), idx.lookup('CA', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
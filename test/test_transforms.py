@@ -0,0 +1,70 @@
+import unittest
+
+
+class TestJamValues(unittest.TestCase):
+
+    def jammer(self):
+        from censuslib.transforms import JamValueMixin
+
+        class Jammer(JamValueMixin):
+            def error(self, row):
+                pass
+
+        return Jammer()
+
+    def test_decode_row(self):
+        """Decoding a whole row gives the same values and flags as jam_float on each cell"""
+        import random
+        from censuslib.transforms import decode_jams, rle
+
+        j = self.jammer()
+
+        values = ['1', '2.5', '.', ' ', '', None, '12', ' 7 ', '0', '.', '.', '3']
+
+        random.seed(1)
+
+        for i in range(100):
+            row = [random.choice(values) for _ in range(random.randint(1, 40))]
+
+            errors = {}
+            expected = [j.jam_float(v, errors, row) for v in row]
+            expected_flags = j.jam_values(errors, row)
+
+            floats, mask, jams = decode_jams(row, j.jam_map)
+
+            floats = floats[0].astype(object)
+            if mask is not None:
+                floats[mask[0]] = None
+
+            self.assertEqual(expected, floats.tolist())
+            self.assertEqual(expected_flags, rle(jams[0]) if jams[0] else None)
+
+    def test_decode_block(self):
+        import numpy as np
+        from censuslib.transforms import decode_jams
+
+        block = [['1', '.', '.', '4'],
+                 ['1', '2', '3', '4'],
+                 [None, '', '.', ' ']]
+
+        floats, mask, jams = decode_jams(block, self.jammer().jam_map)
+
+        self.assertEqual(['mm', None, 'NNmN'], jams)
+        self.assertEqual([1, 0, 1], list(np.isnan(floats).sum(axis=1) > 0))
+        self.assertEqual(mask.tolist(), np.isnan(floats).tolist())
+        self.assertEqual(4.0, floats[0][3])
+
+        # Blocks without jams take the fast path, with no mask
+        floats, mask, jams = decode_jams(block[1:2], self.jammer().jam_map)
+        self.assertIsNone(mask)
+        self.assertEqual([None], jams)
+
+    def test_unknown_jam(self):
+        from censuslib.transforms import decode_jams
+
+        with self.assertRaises(KeyError):
+            decode_jams(['1', 'x'], self.jammer().jam_map)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+
+from cachetest import TempCacheTestCase
+
+
+class FakeWriter(object):
+
+    def __init__(self, datafile):
+        self.datafile = datafile
+        self.headers = None
+        self.rows = []
+        self.closed = False
+
+    def insert_row(self, row):
+        self.rows.append(row)
+
+    def close(self):
+        self.closed = True
+        self.datafile.exists = True
+
+
+class FakeDatafile(object):
+
+    def __init__(self, exists=False):
+        self.exists = exists
+        self.writers = []
+
+    @property
+    def writer(self):
+        w = FakeWriter(self)
+        self.writers.append(w)
+        return w
+
+
+class FakeSource(object):
+
+    class STATES(object):
+        NEW = 'new'
+        INGESTING = 'ingesting'
+        INGESTED = 'ingested'
+        BUILT = 'built'
+
+    def __init__(self, state=STATES.NEW, exists=False):
+        self.state = state
+        self.datafile = FakeDatafile(exists)
+
+
+class FakeBundle(object):
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.commits = []
+
+    def commit(self):
+        self.commits.append({k: s.state for k, s in self.sources.items()})
+
+
+class TestWriteSources(unittest.TestCase):
+
+    def test_write_sources(self):
+        from censuslib.util import write_sources
+
+        sources = {'b01001': FakeSource(), 'b01002': FakeSource()}
+        b = FakeBundle(sources)
+
+        headers = {'b01001': ['stusab', 'b01001001'], 'b01002': ['stusab', 'b01002001']}
+
+        rows = [('b01001', ('ca', 1.0)), ('b01002', ('ca', 2.0)), ('b01003', ('ca', 3.0)),
+                ('b01001', ('ak', 4.0))]
+
+        write_sources(b, sources, headers, rows)
+
+        w1 = sources['b01001'].datafile.writers[0]
+        w2 = sources['b01002'].datafile.writers[0]
+
+        self.assertEqual(headers['b01001'], w1.headers)
+        self.assertEqual([('ca', 1.0), ('ak', 4.0)], w1.rows)
+        self.assertEqual([('ca', 2.0)], w2.rows)
+        self.assertTrue(w1.closed and w2.closed)
+
+        # The sources are marked as ingesting before any rows are written, and as ingested after
+        self.assertEqual([{'b01001': 'ingesting', 'b01002': 'ingesting'},
+                          {'b01001': 'ingested', 'b01002': 'ingested'}], b.commits)
+
+    def test_interrupted(self):
+        from censuslib.util import write_sources
+
+        sources = {'b01001': FakeSource()}
+        b = FakeBundle(sources)
+
+        def rows():
+            yield 'b01001', ('ca', 1.0)
+            raise IOError("Interrupted")
+
+        with self.assertRaises(IOError):
+            write_sources(b, sources, {'b01001': ['stusab', 'b01001001']}, rows())
+
+        # The writer is closed, but the source is left as ingesting
+        self.assertTrue(sources['b01001'].datafile.writers[0].closed)
+        self.assertEqual('ingesting', sources['b01001'].state)
+
+
+class TestNeedsIngest(unittest.TestCase):
+
+    def test_needs_ingest(self):
+        from censuslib.util import needs_ingest
+
+        S = FakeSource.STATES
+
+        self.assertTrue(needs_ingest(FakeSource(S.NEW, exists=False)))
+        self.assertTrue(needs_ingest(FakeSource(S.INGESTED, exists=False)))
+
+        # Interrupted while ingesting
+        self.assertTrue(needs_ingest(FakeSource(S.INGESTING, exists=True)))
+
+        # Finished, and possibly built since
+        self.assertFalse(needs_ingest(FakeSource(S.INGESTED, exists=True)))
+        self.assertFalse(needs_ingest(FakeSource(S.BUILT, exists=True)))
+
+        self.assertTrue(needs_ingest(FakeSource(S.BUILT, exists=True), force=True))
+
+
+class TestJson(TempCacheTestCase):
+
+    def test_cached_json(self):
+        from censuslib.util import cached_json, versioned_cache_path
+
+        path = versioned_cache_path('catalog', 'key', '.json')
+        self.assertEqual('_censuslib/catalog/key-1.json', path)
+
+        built = []
+
+        def build():
+            built.append(1)
+            return set([1, 2, 3])
+
+        for i in range(2):
+            self.assertEqual(set([1, 2, 3]), cached_json(self.cache, path, build, sorted, set))
+
+        self.assertEqual([1], built)
+        self.assertEqual(['key-1.json'], [p for p in self.cache.listdir('_censuslib/catalog')])
+
+    def test_update_json(self):
+        from censuslib.util import update_json, save_json, load_json
+
+        path = '_censuslib/test.json'
+
+        save_json(self.cache, path, {'a': 1})
+
+        def add(key):
+            def f(d):
+                d[key] = len(d)
+                return d
+            return f
+
+        update_json(self.cache, path, add('b'))
+        self.assertEqual({'a': 1, 'b': 1}, load_json(self.cache, path))
+
+        self.assertEqual({'a': 1, 'b': 1, 'c': 2}, update_json(self.cache, path, add('c')))
+        self.assertEqual({'a': 1, 'b': 1, 'c': 2}, load_json(self.cache, path))
+
+        self.assertEqual([], [p for p in self.cache.walkfiles() if p.endswith('.tmp')])
+
+
+if __name__ == '__main__':
+    unittest.main()
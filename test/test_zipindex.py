@@ -0,0 +1,62 @@
+import unittest
+
+from cachetest import TempCacheTestCase
+
+
+class TestZipIndex(TempCacheTestCase):
+
+    url = 'http://example.com/files/Alaska.zip'
+
+    def write_archive(self, members):
+        import zipfile
+        from censuslib.download import cache_path, DownloadManifest
+
+        path = cache_path(self.url)
+
+        self.cache.makedir('/'.join(path.split('/')[:-1]), recursive=True, allow_recreate=True)
+
+        with self.cache.open(path, 'wb') as f:
+            zf = zipfile.ZipFile(f, 'w')
+            for name, data, compression in members:
+                zf.writestr(name, data, compression)
+            zf.close()
+
+        DownloadManifest(self.cache).record(self.url, path)
+
+    def test_read_members(self):
+        import zipfile
+        from censuslib.zipindex import ZipIndex
+
+        e_rows = [['ACSSF', 'ak', '000', str(i), '1.5', '.'] for i in range(20000)]
+        m_rows = [['ACSSF', 'ak', '000', str(i), '0.5', ' '] for i in range(20000)]
+
+        def csv_data(rows):
+            return ''.join(','.join(r) + '\r\n' for r in rows)
+
+        self.write_archive([
+            ('e20145ak0001000.txt', csv_data(e_rows), zipfile.ZIP_DEFLATED),
+            ('m20145ak0001000.txt', csv_data(m_rows), zipfile.ZIP_STORED)
+        ])
+
+        zi = ZipIndex(self.cache)
+
+        self.assertEqual(e_rows, list(zi.rows(self.url, 'e20145ak0001000.txt')))
+        self.assertEqual(m_rows, list(zi.rows(self.url, 'm20145ak0001000.txt')))
+
+        # The index is persisted, and used by the next instance
+        zi = ZipIndex(self.cache)
+        self.assertIn(self.url, zi.entries)
+        self.assertEqual(m_rows[:10], list(zi.rows(self.url, r'm20145ak.*\.txt'))[:10])
+
+        with self.assertRaises(KeyError):
+            zi.find(self.url, 'e20145ca0001000.txt')
+
+    def test_not_downloaded(self):
+        from censuslib.zipindex import ZipIndex
+
+        with self.assertRaises(IOError):
+            list(ZipIndex(self.cache).rows(self.url, 'e20145ak0001000.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()